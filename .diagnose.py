@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import os
+import time
 
 def check_python():
     print("🐍 Python check:")
@@ -22,8 +23,18 @@ def check_dependencies():
 def check_app():
     print("🔧 App check:")
     try:
-        from app import app
+        # Importing app must not connect to the database; keep this in the milliseconds
+        started = time.perf_counter()
+        import app
+        import_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        app.create_app({"WARM_PRODUCT_CODES": False})
+        create_ms = (time.perf_counter() - started) * 1000
+
         print("   ✅ Flask app imports successfully")
+        print(f"   ⏱️  import app: {import_ms:.1f} ms, create_app(): {create_ms:.1f} ms")
+        print("   (run `python -X importtime -c \"import app\"` for a per-module breakdown)")
         return True
     except Exception as e:
         print(f"   ❌ Flask app import failed: {e}")
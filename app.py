@@ -1,32 +1,76 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify
 from flask_cors import CORS
-from db import crud
+from db import get_crud, get_code_index, get_jobs, get_reports, test_db_connection
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 import os
 
-app = Flask(__name__)
-CORS(app)
+api = Blueprint("api", __name__)
 
-@app.route("/api/products", methods=["GET"])
+# Endpoints answered with JSON built by Postgres (see json_rows.py) unless
+# IMS_FAST_JSON_ENDPOINTS says otherwise
+DEFAULT_FAST_JSON_ENDPOINTS = "sales_report,low_stock_report,inventory_snapshot_report"
+
+def _use_fast_json(endpoint):
+    """?fast=1 / ?fast=0 overrides the per-endpoint setting for one request"""
+    override = request.args.get("fast")
+    if override is not None:
+        return override.lower() in ("1", "true", "yes")
+    return endpoint in current_app.config["FAST_JSON_ENDPOINTS"]
+
+def _json_bytes(body, status=200):
+    return Response(body, status=status, mimetype="application/json")
+
+def _whole_number(value):
+    """int(value), but 1.5 (or True) is rejected instead of truncated"""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"{value!r} is not a whole number")
+    return int(value)
+
+def start_code_index(app):
+    """Warm the product code index in the background when WARM_PRODUCT_CODES
+    is on; returns the index. Safe to call repeatedly."""
+    code_index = get_code_index()
+    if app.config["WARM_PRODUCT_CODES"]:
+        code_index.start(wait=False)
+    return code_index
+
+@api.route("/api/products", methods=["GET"])
 def list_products():
     q = request.args.get("q", "").strip()
     limit = int(request.args.get("limit", 100))
+    location_id = request.args.get("location_id", type=int)
     
     try:
-        print(f"DEBUG: list_products called - q='{q}', limit={limit}")
+        print(f"DEBUG: list_products called - q='{q}', limit={limit}, location_id={location_id}")
         
+        if _use_fast_json("list_products"):
+            return _json_bytes(get_crud().list_products_json(
+                search_term=q, limit=limit, location_id=location_id))
+
         # Use the crud.list_products method instead of raw SQL
-        products = crud.list_products(search_term=q, limit=limit)
+        products = get_crud().list_products(search_term=q, limit=limit, location_id=location_id)
         return jsonify(products), 200
             
     except Exception as e:
         print(f"DEBUG: ERROR in list_products: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/products/<int:product_id>", methods=["GET"])
+@api.route("/api/products/export", methods=["GET"])
+def export_products():
+    try:
+        print("DEBUG: export_products called")
+        # Streamed straight from a server-side cursor; never materialized in Python
+        return _json_bytes(get_crud().stream_products_json())
+    except Exception as e:
+        print(f"DEBUG: ERROR in export_products: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/products/<int:product_id>", methods=["GET"])
 def get_product(product_id):
     try:
         print(f"DEBUG: get_product called - id={product_id}")
-        product = crud.get_product(product_id)
+        product = get_crud().get_product(product_id)
         
         if not product:
             return jsonify({"error": "Product not found"}), 404
@@ -36,7 +80,30 @@ def get_product(product_id):
         print(f"DEBUG: ERROR in get_product: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/products", methods=["POST"])
+@api.route("/api/products/code/<product_code>", methods=["GET"])
+def get_product_by_code(product_code):
+    try:
+        # Normally already started at startup (or by the readiness probe)
+        entry = start_code_index(current_app).lookup(product_code)
+        if entry:
+            product_id, price = entry
+            return jsonify({"id": product_id, "product_code": product_code, "price": price}), 200
+
+        # Index not warm yet or code just added: fall back to the database
+        product = get_crud().get_product_by_code(product_code)
+        if not product:
+            return jsonify({"error": "Product not found"}), 404
+
+        return jsonify({
+            "id": product["id"],
+            "product_code": product["product_code"],
+            "price": product["price"]
+        }), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in get_product_by_code: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/products", methods=["POST"])
 def create_product():
     data = request.get_json(force=True)
     required = ["name", "price"]  
@@ -48,7 +115,7 @@ def create_product():
     try:
         print(f"DEBUG: create_product called - name={data['name']}")
         
-        new_id = crud.add_product(
+        new_id = get_crud().add_product(
             name=data["name"],
             current_quantity=int(data.get("quantity", 0)),  
             price=float(data["price"]),
@@ -64,7 +131,7 @@ def create_product():
         print(f"DEBUG: ERROR in create_product: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/products/<int:product_id>", methods=["PUT", "PATCH"])
+@api.route("/api/products/<int:product_id>", methods=["PUT", "PATCH"])
 def update_product(product_id):
     data = request.get_json(force=True)
     
@@ -74,7 +141,7 @@ def update_product(product_id):
     try:
         print(f"DEBUG: update_product called - id={product_id}")
         
-        success = crud.update_product(
+        success = get_crud().update_product(
             product_id=product_id,
             name=data.get("name"),
             current_quantity=(int(data["quantity"]) if "quantity" in data else None),
@@ -93,7 +160,7 @@ def update_product(product_id):
         print(f"DEBUG: ERROR in update_product: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/products/<int:product_id>", methods=["DELETE"])
+@api.route("/api/products/<int:product_id>", methods=["DELETE"])
 def delete_product(product_id):
     permanent = request.args.get("permanent", "false").lower() in ("1", "true", "yes")
     user_id = None
@@ -104,7 +171,7 @@ def delete_product(product_id):
     try:
         print(f"DEBUG: delete_product called - id={product_id}, permanent={permanent}")
         
-        crud.delete_product(
+        get_crud().delete_product(
             product_id=product_id, 
             last_updated_by=user_id,  
             permanent=permanent
@@ -116,24 +183,331 @@ def delete_product(product_id):
         print(f"DEBUG: ERROR in delete_product: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/health", methods=["GET"])
+@api.route("/api/products/<int:product_id>/history", methods=["GET"])
+def product_history(product_id):
+    start = request.args.get("start")
+    end = request.args.get("end")
+    limit = min(request.args.get("limit", 200, type=int), 1000)
+
+    try:
+        start = datetime.fromisoformat(start) if start else None
+        end = datetime.fromisoformat(end) if end else None
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO dates or timestamps"}), 400
+
+    try:
+        print(f"DEBUG: product_history called - id={product_id}")
+        history = get_crud().audit.history(product_id, start, end, limit)
+        return jsonify(history), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"DEBUG: ERROR in product_history: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+MAX_BULK_ITEMS = 50000
+
+def _bulk_result_response(results):
+    failed = [r for r in results if r["status"] != "updated"]
+    status = 409 if any(r["status"] == "rolled_back" for r in results) else 200
+    return jsonify({
+        "updated": len(results) - len(failed),
+        "failed": len(failed),
+        "results": results
+    }), status
+
+@api.route("/api/stock/adjustments", methods=["POST"])
+def adjust_stock():
+    data = request.get_json(force=True)
+    items = data.get("items") if data else None
+
+    if not items:
+        return jsonify({"error": "Missing field: items"}), 400
+    if len(items) > MAX_BULK_ITEMS:
+        return jsonify({"error": f"At most {MAX_BULK_ITEMS} items per request"}), 400
+
+    try:
+        adjustments = [(_whole_number(item["product_id"]), _whole_number(item["delta"]))
+                       for item in items]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Each item needs an integer product_id and delta"}), 400
+
+    location_id = data.get("location_id")
+    if location_id is not None and not isinstance(location_id, int):
+        return jsonify({"error": "location_id must be an integer"}), 400
+
+    try:
+        print(f"DEBUG: adjust_stock called - items={len(adjustments)}")
+
+        results = get_crud().adjust_stock_bulk(
+            adjustments,
+            last_updated_by=data.get("user_id"),
+            all_or_nothing=bool(data.get("all_or_nothing", False)),
+            location_id=location_id
+        )
+        return _bulk_result_response(results)
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"DEBUG: ERROR in adjust_stock: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/goods-receipts", methods=["POST"])
+def receive_goods():
+    data = request.get_json(force=True)
+    items = data.get("items") if data else None
+
+    if not items:
+        return jsonify({"error": "Missing field: items"}), 400
+    if len(items) > MAX_BULK_ITEMS:
+        return jsonify({"error": f"At most {MAX_BULK_ITEMS} items per request"}), 400
+
+    try:
+        adjustments = [(_whole_number(item["product_id"]), _whole_number(item["quantity"]))
+                       for item in items]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Each item needs an integer product_id and quantity"}), 400
+
+    location_id = data.get("location_id")
+    if location_id is not None and not isinstance(location_id, int):
+        return jsonify({"error": "location_id must be an integer"}), 400
+
+    if any(quantity <= 0 for _, quantity in adjustments):
+        return jsonify({"error": "Received quantities must be positive"}), 400
+
+    try:
+        unit_costs = {int(item["product_id"]): Decimal(str(item["unit_cost"]))
+                      for item in items if item.get("unit_cost") is not None}
+    except (InvalidOperation, ValueError):
+        return jsonify({"error": "unit_cost must be a number"}), 400
+
+    try:
+        print(f"DEBUG: receive_goods called - items={len(adjustments)}")
+
+        # A delivery is booked in full or not at all
+        results = get_crud().adjust_stock_bulk(
+            adjustments,
+            last_updated_by=data.get("user_id"),
+            all_or_nothing=True,
+            location_id=location_id,
+            unit_costs=unit_costs
+        )
+        return _bulk_result_response(results)
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"DEBUG: ERROR in receive_goods: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/locations", methods=["GET"])
+def list_locations():
+    try:
+        return jsonify(get_crud().list_locations()), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in list_locations: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/reports/sales", methods=["GET"])
+def sales_report():
+    start_date = request.args.get("start_date")
+    end_date = request.args.get("end_date")
+    category_id = request.args.get("category_id", type=int)
+    location_id = request.args.get("location_id", type=int)
+
+    if not start_date or not end_date:
+        return jsonify({"error": "start_date and end_date are required"}), 400
+
+    try:
+        print(f"DEBUG: sales_report called - {start_date}..{end_date} location_id={location_id}")
+        if _use_fast_json("sales_report"):
+            return _json_bytes(get_reports().sales_report_json(
+                start_date, end_date, category_id, location_id))
+        return jsonify(get_reports().sales_report(start_date, end_date, category_id, location_id)), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in sales_report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/reports/low-stock", methods=["GET"])
+def low_stock_report():
+    location_id = request.args.get("location_id", type=int)
+    try:
+        print(f"DEBUG: low_stock_report called - location_id={location_id}")
+        if _use_fast_json("low_stock_report"):
+            return _json_bytes(get_reports().low_stock_report_json(location_id))
+        return jsonify(get_reports().low_stock_report(location_id)), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in low_stock_report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/reports/inventory-snapshot", methods=["GET"])
+def inventory_snapshot_report():
+    location_id = request.args.get("location_id", type=int)
+    try:
+        print(f"DEBUG: inventory_snapshot_report called - location_id={location_id}")
+        if _use_fast_json("inventory_snapshot_report"):
+            return _json_bytes(get_reports().inventory_snapshot_json(location_id))
+        return jsonify(get_reports().inventory_snapshot(location_id)), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in inventory_snapshot_report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/reports/monthly-inventory", methods=["GET"])
+def monthly_inventory_report():
+    year = request.args.get("year", type=int)
+    month = request.args.get("month", type=int)
+    method = request.args.get("method", "weighted_average")
+    try:
+        print(f"DEBUG: monthly_inventory_report called - {year}-{month} method={method}")
+        return jsonify(get_reports().monthly_inventory_report(year, month, method)), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"DEBUG: ERROR in monthly_inventory_report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/reports/valuation", methods=["GET"])
+def valuation_report():
+    as_of = request.args.get("as_of")
+    method = request.args.get("method", "weighted_average")
+
+    if not as_of:
+        return jsonify({"error": "as_of is required (YYYY-MM-DD)"}), 400
+
+    try:
+        as_of = date.fromisoformat(as_of)
+    except ValueError:
+        return jsonify({"error": "as_of must be a date (YYYY-MM-DD)"}), 400
+
+    try:
+        print(f"DEBUG: valuation_report called - as_of={as_of} method={method}")
+        return jsonify(get_reports().valuation.valuation_at(as_of, method)), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"DEBUG: ERROR in valuation_report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/jobs", methods=["POST"])
+def enqueue_job():
+    from jobs import REGISTRY
+
+    data = request.get_json(force=True) or {}
+    task_name = data.get("task")
+    payload = data.get("payload") or {}
+
+    if not task_name:
+        return jsonify({"error": "Missing field: task"}), 400
+    if not isinstance(payload, dict):
+        return jsonify({"error": "payload must be an object"}), 400
+
+    try:
+        jobs = get_jobs()
+        if task_name not in REGISTRY:
+            return jsonify({"error": f"Unknown task: {task_name}"}), 400
+
+        print(f"DEBUG: enqueue_job called - task={task_name}")
+        job_id = jobs.enqueue(task_name, payload, priority=int(data.get("priority", 0)))
+        return jsonify({"id": job_id, "task": task_name, "status": "queued"}), 202
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"DEBUG: ERROR in enqueue_job: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    try:
+        job = get_jobs().get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in get_job: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/jobs/metrics", methods=["GET"])
+def job_metrics():
+    since = request.args.get("since", 86400, type=int)
+    try:
+        return jsonify(get_jobs().metrics(since)), 200
+    except Exception as e:
+        print(f"DEBUG: ERROR in job_metrics: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/health", methods=["GET"])
 def health_check():
     return jsonify({"status": "healthy", "service": "inventory-api"}), 200
 
+@api.route("/api/ready", methods=["GET"])
+def readiness_check():
+    ok, message = test_db_connection()
+    # A fresh worker is not ready until its code index is warm, so till scans
+    # are not all sent to the database
+    code_index = start_code_index(current_app)
+    warming = current_app.config["WARM_PRODUCT_CODES"] and not code_index.is_warm
+    body = {
+        "status": "unavailable" if not ok else "warming" if warming else "ready",
+        "database": message,
+        "product_code_index_warm": code_index.is_warm,
+        "product_codes_indexed": len(code_index)
+    }
+    return jsonify(body), 200 if ok and not warming else 503
+
+def create_app(config=None):
+    """Build the Flask app without touching the database.
+    The connection pool is opened by the first request that needs it. The
+    product code index is warmed by start_code_index(): at startup when run
+    directly, otherwise by the first readiness probe or code lookup.
+
+    Run a job worker (python jobs.py worker) alongside the app: its
+    fold_stock_totals job keeps products.current_quantity and the
+    product_stock_deltas table in check. Reads add the changes not yet folded,
+    so stock shows sales straight away either way."""
+    app = Flask(__name__)
+    app.config.update(
+        WARM_PRODUCT_CODES=os.getenv("IMS_WARM_PRODUCT_CODES", "true").lower() in ("1", "true", "yes"),
+        REQUIRE_DATABASE=os.getenv("IMS_REQUIRE_DATABASE", "false").lower() in ("1", "true", "yes"),
+        FAST_JSON_ENDPOINTS={
+            name.strip()
+            for name in os.getenv("IMS_FAST_JSON_ENDPOINTS", DEFAULT_FAST_JSON_ENDPOINTS).split(",")
+            if name.strip()
+        }
+    )
+    if config:
+        app.config.update(config)
+
+    CORS(app)
+    app.register_blueprint(api)
+
+    if app.config["REQUIRE_DATABASE"]:
+        # Fail fast instead of starting a worker that cannot serve
+        ok, message = test_db_connection()
+        if not ok:
+            raise RuntimeError(message)
+
+    return app
+
+app = create_app()
+
 if __name__ == "__main__":
     port = int(os.getenv("FLASK_PORT", 5000))
     debug = os.getenv("FLASK_ENV", "development") == "development"
     
-    # Print all registered routes
-    print("\n" + "="*50)
-    print("🚀 Flask Application Routes:")
-    print("="*50)
-    for rule in app.url_map.iter_rules():
-        methods = ','.join(sorted(rule.methods.difference(['HEAD', 'OPTIONS'])))
-        print(f"  {rule.rule} [{methods}] -> {rule.endpoint}")
-    print("="*50)
+    if debug:
+        # Print all registered routes
+        print("\n" + "="*50)
+        print("🚀 Flask Application Routes:")
+        print("="*50)
+        for rule in app.url_map.iter_rules():
+            methods = ','.join(sorted(rule.methods.difference(['HEAD', 'OPTIONS'])))
+            print(f"  {rule.rule} [{methods}] -> {rule.endpoint}")
+        print("="*50)
     print(f"📡 Server starting on: http://localhost:{port}")
     print(f"🔧 Debug mode: {debug}")
     print("="*50 + "\n")
+
+    # With the reloader only the child process serves requests
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_code_index(app)
     
     app.run(host="0.0.0.0", port=port, debug=debug)
@@ -0,0 +1,123 @@
+"""Compare plain vs server-side prepared execution of the CRUD hot paths.
+
+Each thread holds one connection (as a pooled worker would) and runs the
+same registry statements twice: once sending their full SQL text every time
+(plain_sql), once through prepared_statements.execute_prepared, so the
+difference is the parse/plan work saved. --dynamic adds a third run with
+the f-string UPDATE update_product used to build. Usage:
+
+    python bench_prepared_statements.py --threads 8 --iterations 2000
+"""
+import argparse
+import random
+import threading
+import time
+
+import psycopg2
+
+from db import get_config
+from prepared_statements import STATEMENTS, execute_statement
+
+UPDATE_FIELDS = ["name", "price", "reorder_threshold", "category_id"]
+
+
+def dynamic_update_sql(fields):
+    # What update_product used to send: statement text varies with the fields given
+    updates = [f"{field} = {field}" for field in fields]
+    updates.append("last_updated_by = %s")
+    return f"""
+        UPDATE products
+        SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    """
+
+
+def workload(mode, cursor, product_ids, rng):
+    product_id = rng.choice(product_ids)
+    kind = rng.random()
+    prepare = mode == "prepared"
+
+    if kind < 0.6:
+        execute_statement(cursor, "product_get_by_id", (product_id,), prepare=prepare)
+        cursor.fetchall()
+    elif kind < 0.8:
+        execute_statement(cursor, "product_search", ("%a%", 20), prepare=prepare)
+        cursor.fetchall()
+    elif mode == "dynamic":
+        fields = rng.sample(UPDATE_FIELDS, rng.randint(1, len(UPDATE_FIELDS)))
+        cursor.execute(dynamic_update_sql(fields), (1, product_id))
+    else:
+        # NULL for every field keeps the row unchanged
+        execute_statement(cursor, "product_update", (product_id, None, None, None, None, 1),
+                          prepare=prepare)
+        cursor.fetchall()
+
+
+def run(mode, config, product_ids, threads, iterations):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        conn = psycopg2.connect(**config)
+        cursor = conn.cursor()
+        local = []
+        try:
+            for _ in range(iterations):
+                started = time.perf_counter()
+                workload(mode, cursor, product_ids, rng)
+                conn.rollback()  # leave the data as it was
+                local.append(time.perf_counter() - started)
+        finally:
+            cursor.close()
+            conn.close()
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "ops_per_sec": len(latencies) / elapsed,
+        "mean_us": sum(latencies) / len(latencies) * 1e6,
+        "p95_us": latencies[int(len(latencies) * 0.95)] * 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--dynamic", action="store_true",
+                        help="also time the old f-string UPDATE (a different statement)")
+    args = parser.parse_args()
+
+    config = get_config()
+
+    conn = psycopg2.connect(**config)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM products WHERE archived = FALSE")
+    product_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+
+    if not product_ids:
+        raise SystemExit("Benchmark needs at least one active product.")
+
+    print(f"{len(product_ids)} products, {args.threads} threads x {args.iterations} ops, "
+          f"statements: {', '.join(sorted(STATEMENTS))}")
+
+    modes = ("plain", "prepared", "dynamic") if args.dynamic else ("plain", "prepared")
+    results = [run(mode, config, product_ids, args.threads, args.iterations) for mode in modes]
+    for r in results:
+        print(f"  {r['mode']:<9} {r['ops_per_sec']:>9.0f} ops/s   "
+              f"mean {r['mean_us']:>7.0f} us   p95 {r['p95_us']:>7.0f} us")
+
+    plain, prepared = results[:2]
+    print(f"  prepared speedup: {prepared['ops_per_sec'] / plain['ops_per_sec']:.2f}x")
@@ -0,0 +1,79 @@
+"""Compare Python-side CPU and memory of the two product list JSON paths.
+
+  dict: RealDictCursor rows + Flask's JSON provider (what jsonify does)
+  fast: json_agg built by Postgres, returned as bytes (json_rows.py)
+
+Usage:
+
+    python bench_row_decoding.py --rows 50000 --repeat 5
+"""
+import argparse
+import time
+import tracemalloc
+
+import psycopg2
+from flask import Flask
+from psycopg2.extras import RealDictCursor
+
+from db import get_config
+from json_rows import fetch_json_array
+from prepared_statements import plain_sql
+
+
+def dict_path(conn, app, limit):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(plain_sql("product_list"), {"p1": limit})
+    rows = cursor.fetchall()
+    body = app.json.dumps(rows).encode()
+    cursor.close()
+    return len(rows), body
+
+
+def fast_path(conn, app, limit):
+    cursor = conn.cursor()
+    body = fetch_json_array(cursor, plain_sql("product_list"), {"p1": limit})
+    cursor.close()
+    return None, body
+
+
+def measure(path, conn, app, limit, repeat):
+    cpu = []
+    for _ in range(repeat):
+        started = time.process_time()
+        path(conn, app, limit)
+        cpu.append(time.process_time() - started)
+        conn.rollback()
+
+    tracemalloc.start()
+    _, body = path(conn, app, limit)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    conn.rollback()
+
+    return min(cpu), peak, len(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**get_config())
+    app = Flask(__name__)
+
+    with app.app_context():
+        rows, _ = dict_path(conn, app, args.rows)
+        conn.rollback()
+        print(f"{rows} rows (best of {args.repeat}, Python process CPU only)")
+
+        results = {}
+        for name, path in (("dict", dict_path), ("fast", fast_path)):
+            results[name] = measure(path, conn, app, args.rows, args.repeat)
+            cpu, peak, size = results[name]
+            print(f"  {name}: {cpu * 1000:8.1f} ms CPU  {cpu / max(rows, 1) * 1e6:6.2f} us/row  "
+                  f"peak {peak / 1024 / 1024:7.1f} MiB  body {size / 1024:.0f} KiB")
+
+    print(f"  CPU reduction: {results['dict'][0] / max(results['fast'][0], 1e-9):.1f}x, "
+          f"peak memory reduction: {results['dict'][1] / max(results['fast'][1], 1):.1f}x")
+    conn.close()
@@ -0,0 +1,432 @@
+"""Drive many simulated tills through checkout at once and check the books balance.
+
+Each till repeatedly scans products (get_product), checks out through
+sale_transaction.finalize_transaction and, now and then, changes a price
+with InventoryCRUD.update_product, all against the same few hot SKUs. The
+run creates its own stress products, so afterwards it can verify that
+
+  - every SKU's stock dropped by exactly the quantity recorded in sale_item,
+    and by what the tills believe they sold
+  - no stock went negative
+  - sale_transaction totals match the totals the tills computed
+
+and reports throughput, latency, lock waits (sampled from pg_stat_activity),
+deadlocks (pg_stat_database plus the errors tills saw) and retries.
+Only run it against a local or scratch database. Usage:
+
+    python checkout_stress.py --tills 50 --sales 200 --skus 1
+    python checkout_stress.py --tills 16 --processes --location-id 1
+
+Exits with status 1 when a consistency check fails.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from decimal import ROUND_HALF_UP, Decimal
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+from db import get_config
+from inventory_crud_pg import InventoryCRUD
+from product_audit import ProductAuditLog
+from sale_transaction import sale_transaction
+from sale_transaction_crud import sale_transaction_crud
+
+TAX_RATE = Decimal("0.15")
+DISCOUNT_RATE = Decimal("0")
+
+
+_audit = None
+_audit_lock = threading.Lock()
+
+
+def shared_audit_log(config):
+    """One audit writer (and connection) per process, like the app's single CRUD"""
+    global _audit
+    with _audit_lock:
+        if _audit is None:
+            _audit = ProductAuditLog(**config)
+        return _audit
+
+
+def _init_till_process():
+    """ProcessPoolExecutor initializer. A forked till inherits the parent's
+    audit log, whose writer thread did not survive the fork; start afresh."""
+    global _audit, _audit_lock
+    _audit = None
+    _audit_lock = threading.Lock()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def create_products(crud, run_id, skus, initial_stock, location_id):
+    product_ids = [
+        crud.add_product(
+            name=f"Stress SKU {run_id}-{n}",
+            current_quantity=0 if location_id is not None else initial_stock,
+            price=Decimal("1.00") + n,
+            product_code=f"STRESS-{run_id}-{n}",
+            reorder_threshold=0
+        )
+        for n in range(skus)
+    ]
+    if location_id is not None:
+        crud.adjust_stock_bulk([(pid, initial_stock) for pid in product_ids],
+                               location_id=location_id, all_or_nothing=True)
+    return product_ids
+
+
+def run_till(config, till_id, product_ids, options, pool=None, start_at=None):
+    """One till's workload. Returns its counters and latencies."""
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadedConnectionPool(1, 2, **config)
+    crud = InventoryCRUD(**config, pool=pool, audit=shared_audit_log(config))
+    sales_db = sale_transaction_crud(**config, pool=pool)
+    rng = random.Random(options["seed"] * 1000 + till_id)
+
+    stats = {
+        "checkouts": 0, "out_of_stock": 0, "price_updates": 0,
+        "retries": 0, "deadlocks": 0, "serialization_failures": 0,
+        "errors": [], "sold": {}, "sales_total": "0",
+        "checkout_ms": [], "update_ms": []
+    }
+    sales_total = Decimal("0")
+
+    if start_at:
+        time.sleep(max(0.0, start_at - time.time()))
+
+    try:
+        for _ in range(options["sales"]):
+            if rng.random() < options["update_ratio"]:
+                product_id = rng.choice(product_ids)
+                price = Decimal(rng.randint(100, 999)) / 100
+                started = time.perf_counter()
+                attempt = _with_retries(
+                    lambda: crud.update_product(product_id, price=price, last_updated_by=till_id),
+                    stats, options["max_retries"])
+                if attempt is not None:
+                    stats["price_updates"] += 1
+                    stats["update_ms"].append((time.perf_counter() - started) * 1000)
+                continue
+
+            sale = sale_transaction(TAX_RATE, DISCOUNT_RATE, crud, None, sales_db)
+            picks = rng.sample(product_ids, min(len(product_ids), rng.randint(1, options["items"])))
+            for product_id in picks:
+                product = crud.get_product(product_id)
+                if product is not None:
+                    sale.add_sale_item(product, rng.randint(1, options["max_quantity"]))
+            if not sale.sale_items:
+                continue
+
+            started = time.perf_counter()
+            try:
+                # Safe to retry: the stock decrement and the sale rows commit together
+                totals = _with_retries(
+                    lambda: sale.finalize_transaction(till_id, location_id=options["location_id"]),
+                    stats, options["max_retries"])
+            except ValueError:
+                stats["out_of_stock"] += 1
+                continue
+            if totals is None:
+                continue
+
+            stats["checkout_ms"].append((time.perf_counter() - started) * 1000)
+            stats["checkouts"] += 1
+            # As stored in sale_transaction.total (numeric rounds half away from zero)
+            sales_total += Decimal(totals["total"]).quantize(Decimal("0.01"), ROUND_HALF_UP)
+            for item in sale.sale_items:
+                pid = str(item.product["id"])
+                stats["sold"][pid] = stats["sold"].get(pid, 0) + item.quantity
+    finally:
+        if own_pool:
+            # Till processes exit without running atexit, so write the audit rows now
+            crud.audit.flush()
+            pool.closeall()
+
+    stats["sales_total"] = str(sales_total)
+    return stats
+
+
+def _with_retries(operation, stats, max_retries):
+    """Run operation, retrying on deadlock / serialization failure.
+    Returns its result, or None once retries are used up.
+
+    Only pass operations that run as a single transaction (checkout and
+    update_product do): those errors roll the whole of it back, so a retry
+    cannot apply anything twice. Any other error (a dropped connection may
+    or may not have committed) is recorded and not retried.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return operation()
+        except psycopg2.errors.DeadlockDetected:
+            stats["deadlocks"] += 1
+        except psycopg2.extensions.TransactionRollbackError:
+            stats["serialization_failures"] += 1
+        except ValueError:
+            raise
+        except Exception as e:
+            stats["errors"].append(f"{type(e).__name__}: {str(e).strip()}")
+            return None
+        if attempt < max_retries:
+            stats["retries"] += 1
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+    stats["errors"].append("Gave up after retries")
+    return None
+
+
+class LockWaitSampler(threading.Thread):
+    """Samples backends of this database that are waiting on a lock"""
+
+    def __init__(self, config, interval=0.05):
+        super().__init__(name="lock-wait-sampler", daemon=True)
+        self.config = config
+        self.interval = interval
+        self.samples = []
+        self._done = threading.Event()
+
+    def run(self):
+        conn = psycopg2.connect(**self.config)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        try:
+            while not self._done.is_set():
+                cursor.execute("""
+                    SELECT COUNT(*)
+                    FROM pg_stat_activity
+                    WHERE datname = current_database()
+                    AND wait_event_type = 'Lock'
+                """)
+                self.samples.append(cursor.fetchone()[0])
+                self._done.wait(self.interval)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def database_deadlocks(cursor):
+    cursor.execute("SELECT pg_stat_clear_snapshot()")
+    cursor.execute("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()")
+    return cursor.fetchone()[0]
+
+
+def verify(cursor, product_ids, initial_stock, location_id, till_stats):
+    """Compare the database with what the tills report. Returns failed checks."""
+    failures = []
+    sold_by_tills = {}
+    for stats in till_stats:
+        for pid, quantity in stats["sold"].items():
+            sold_by_tills[int(pid)] = sold_by_tills.get(int(pid), 0) + quantity
+
+    cursor.execute("""
+        SELECT product_id, quantity FROM product_stock
+        WHERE location_id = COALESCE(%s, (SELECT id FROM locations WHERE code = 'MAIN'))
+        AND product_id = ANY(%s)
+    """, (location_id, product_ids))
+    stock = dict(cursor.fetchall())
+
+    # Once folded, each product total must equal its stock over all locations
+    cursor.execute("SELECT fold_product_stock_totals(%s)", (product_ids,))
+    cursor.execute("""
+        SELECT p.id, p.current_quantity, COALESCE(SUM(ps.quantity), 0)
+        FROM products p
+        LEFT JOIN product_stock ps ON ps.product_id = p.id
+        WHERE p.id = ANY(%s)
+        GROUP BY p.id
+        HAVING p.current_quantity <> COALESCE(SUM(ps.quantity), 0)
+    """, (product_ids,))
+    for pid, total, located in cursor.fetchall():
+        failures.append(f"product {pid}: current_quantity {total} but location stock sums to {located}")
+
+    cursor.execute("""
+        SELECT product_id, SUM(quantity)
+        FROM sale_item
+        WHERE product_id = ANY(%s)
+        GROUP BY product_id
+    """, (product_ids,))
+    recorded = dict(cursor.fetchall())
+
+    for pid in product_ids:
+        dropped = initial_stock - stock.get(pid, 0)
+        if stock.get(pid, 0) < 0:
+            failures.append(f"product {pid}: stock went negative ({stock[pid]})")
+        if dropped != recorded.get(pid, 0):
+            failures.append(f"product {pid}: stock dropped by {dropped} "
+                            f"but sale_item records {recorded.get(pid, 0)}")
+        if dropped != sold_by_tills.get(pid, 0):
+            failures.append(f"product {pid}: stock dropped by {dropped} "
+                            f"but tills sold {sold_by_tills.get(pid, 0)}")
+
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(SUM(total), 0)
+        FROM sale_transaction
+        WHERE transaction_id IN (
+            SELECT transaction_id FROM sale_item WHERE product_id = ANY(%s)
+        )
+    """, (product_ids,))
+    transactions, db_total = cursor.fetchone()
+
+    checkouts = sum(s["checkouts"] for s in till_stats)
+    till_total = sum(Decimal(s["sales_total"]) for s in till_stats)
+    if transactions != checkouts:
+        failures.append(f"{transactions} sale transactions recorded for {checkouts} checkouts")
+    if db_total != till_total:
+        failures.append(f"sale_transaction totals {db_total} != till totals {till_total}")
+
+    return failures, {"transactions": transactions, "sales_total": str(db_total), "stock": stock}
+
+
+def cleanup(cursor, product_ids):
+    """Remove the stress products and everything recorded about them, so the
+    run leaves no stock, movements or history behind"""
+    cursor.execute("""
+        DELETE FROM sale_transaction WHERE transaction_id IN (
+            SELECT transaction_id FROM sale_item WHERE product_id = ANY(%s)
+        )
+    """, (product_ids,))
+    cursor.execute("DELETE FROM sale_item WHERE product_id = ANY(%s)", (product_ids,))
+    # Deleting stock logs movements and deltas, so it goes before those tables
+    cursor.execute("DELETE FROM product_stock WHERE product_id = ANY(%s)", (product_ids,))
+    for table in ("stock_movements", "product_stock_deltas", "product_audit"):
+        cursor.execute(f"DELETE FROM {table} WHERE product_id = ANY(%s)", (product_ids,))
+    cursor.execute("DELETE FROM products WHERE id = ANY(%s)", (product_ids,))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tills", type=int, default=50)
+    parser.add_argument("--sales", type=int, default=200, help="operations per till")
+    parser.add_argument("--skus", type=int, default=1, help="hot products every till sells")
+    parser.add_argument("--items", type=int, default=3, help="max distinct SKUs per sale")
+    parser.add_argument("--max-quantity", type=int, default=3, help="max units per line")
+    parser.add_argument("--initial-stock", type=int, default=None,
+                        help="per SKU (default: enough for every sale)")
+    parser.add_argument("--update-ratio", type=float, default=0.05,
+                        help="share of operations that are price updates")
+    parser.add_argument("--location-id", type=int, default=None,
+                        help="sell from this location's stock instead of MAIN's")
+    parser.add_argument("--processes", action="store_true",
+                        help="one OS process per till instead of threads")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="leave the stress products and sales")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    config = get_config()
+    run_id = uuid.uuid4().hex[:8]
+    initial_stock = args.initial_stock or args.tills * args.sales * args.max_quantity
+    options = {
+        "sales": args.sales, "items": args.items, "max_quantity": args.max_quantity,
+        "update_ratio": args.update_ratio, "location_id": args.location_id,
+        "max_retries": args.max_retries, "seed": args.seed
+    }
+
+    admin = psycopg2.connect(**config)
+    admin.autocommit = True
+    cursor = admin.cursor()
+
+    setup_crud = InventoryCRUD(**config, audit=shared_audit_log(config))
+    product_ids = create_products(setup_crud, run_id, args.skus, initial_stock, args.location_id)
+    deadlocks_before = database_deadlocks(cursor)
+
+    sampler = LockWaitSampler(config)
+    sampler.start()
+    start_at = time.time() + 0.5  # let every till connect before the first sale
+
+    if args.processes:
+        with ProcessPoolExecutor(max_workers=args.tills,
+                                 initializer=_init_till_process) as executor:
+            futures = [executor.submit(run_till, config, till, product_ids, options, None, start_at)
+                       for till in range(1, args.tills + 1)]
+            till_stats = [f.result() for f in futures]
+    else:
+        pool = ThreadedConnectionPool(1, args.tills + 1, **config)
+        with ThreadPoolExecutor(max_workers=args.tills) as executor:
+            futures = [executor.submit(run_till, config, till, product_ids, options, pool, start_at)
+                       for till in range(1, args.tills + 1)]
+            till_stats = [f.result() for f in futures]
+        pool.closeall()
+
+    elapsed = time.time() - start_at
+    sampler.stop()
+    time.sleep(1.0)  # cumulative statistics are flushed about once a second
+    deadlocks_after = database_deadlocks(cursor)
+
+    failures, database = verify(cursor, product_ids, initial_stock, args.location_id, till_stats)
+
+    checkout_ms = [ms for s in till_stats for ms in s["checkout_ms"]]
+    update_ms = [ms for s in till_stats for ms in s["update_ms"]]
+    errors = [e for s in till_stats for e in s["errors"]]
+    checkouts = sum(s["checkouts"] for s in till_stats)
+    samples = sampler.samples or [0]
+
+    report = {
+        "run_id": run_id,
+        "mode": "processes" if args.processes else "threads",
+        "tills": args.tills,
+        "skus": args.skus,
+        "location_id": args.location_id,
+        "elapsed_s": round(elapsed, 3),
+        "checkouts": checkouts,
+        "checkouts_per_s": round(checkouts / elapsed, 1),
+        "price_updates": sum(s["price_updates"] for s in till_stats),
+        "out_of_stock": sum(s["out_of_stock"] for s in till_stats),
+        "checkout_ms": {"p50": round(percentile(checkout_ms, 0.5), 2),
+                        "p95": round(percentile(checkout_ms, 0.95), 2),
+                        "p99": round(percentile(checkout_ms, 0.99), 2)},
+        "update_ms": {"p50": round(percentile(update_ms, 0.5), 2),
+                      "p95": round(percentile(update_ms, 0.95), 2)},
+        "lock_waiters": {"mean": round(sum(samples) / len(samples), 2),
+                         "max": max(samples),
+                         "share_of_samples": round(sum(1 for n in samples if n) / len(samples), 3)},
+        "deadlocks": {"database": deadlocks_after - deadlocks_before,
+                      "seen_by_tills": sum(s["deadlocks"] for s in till_stats)},
+        "serialization_failures": sum(s["serialization_failures"] for s in till_stats),
+        "retries": sum(s["retries"] for s in till_stats),
+        "errors": len(errors),
+        "database": {"transactions": database["transactions"], "sales_total": database["sales_total"]},
+        "consistent": not failures and not errors,
+        "failures": failures + errors[:20],
+    }
+
+    if not args.keep:
+        shared_audit_log(config).flush()  # nothing may land in product_audit after cleanup
+        cleanup(cursor, product_ids)
+    admin.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"run {run_id}: {args.tills} tills ({report['mode']}), {args.skus} SKU(s), "
+              f"{report['elapsed_s']} s")
+        print(f"  checkouts      {checkouts} ({report['checkouts_per_s']}/s), "
+              f"{report['out_of_stock']} out of stock, {report['price_updates']} price updates")
+        print(f"  checkout ms    p50 {report['checkout_ms']['p50']}  p95 {report['checkout_ms']['p95']}  "
+              f"p99 {report['checkout_ms']['p99']}")
+        print(f"  update ms      p50 {report['update_ms']['p50']}  p95 {report['update_ms']['p95']}")
+        print(f"  lock waiters   mean {report['lock_waiters']['mean']}  max {report['lock_waiters']['max']}  "
+              f"waiting in {report['lock_waiters']['share_of_samples']:.0%} of samples")
+        print(f"  deadlocks      {report['deadlocks']['database']} (database), "
+              f"{report['deadlocks']['seen_by_tills']} (tills); "
+              f"{report['serialization_failures']} serialization failures, {report['retries']} retries")
+        print(f"  consistency    {'OK' if report['consistent'] else 'FAILED'}")
+        for failure in report["failures"]:
+            print(f"    - {failure}")
+
+    raise SystemExit(0 if report["consistent"] else 1)
@@ -0,0 +1,76 @@
+"""Every database class builds on DatabaseClient and can be constructed
+without a database: connections are only opened by connect()."""
+import psycopg2
+import pytest
+
+from db import DatabaseClient
+from inventory_crud_pg import InventoryCRUD
+from inventory_valuation import InventoryValuation
+from jobs import JobQueue
+from product_audit import ProductAuditLog
+from product_code_index import ProductCodeIndex
+from reorder_forecast import ReorderForecast
+from reports_crud import ReportsCRUD
+from sale_transaction_crud import sale_transaction_crud
+
+CONFIG = {"host": "db.invalid", "database": "ims", "user": "ims_user", "password": "secret"}
+
+CLIENTS = [
+    InventoryCRUD, InventoryValuation, JobQueue, ProductAuditLog,
+    ProductCodeIndex, ReorderForecast, ReportsCRUD, sale_transaction_crud,
+]
+
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    def connect(*args, **kwargs):
+        raise AssertionError("constructor opened a database connection")
+    monkeypatch.setattr(psycopg2, "connect", connect)
+
+
+def all_subclasses(cls):
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from all_subclasses(sub)
+
+
+def test_every_client_is_listed():
+    assert set(all_subclasses(DatabaseClient)) <= set(CLIENTS)
+
+
+@pytest.mark.parametrize("cls", CLIENTS, ids=lambda cls: cls.__name__)
+def test_construct_without_database(cls):
+    assert issubclass(cls, DatabaseClient)
+    client = cls(**CONFIG)
+    assert client.config == CONFIG
+    assert client.pool is None
+
+
+@pytest.mark.parametrize("cls", [c for c in CLIENTS if c not in (ProductCodeIndex, ReorderForecast)],
+                         ids=lambda cls: cls.__name__)
+def test_pooled_client_uses_pool(cls):
+    class Conn:
+        closed = 0
+
+    class Pool:
+        def __init__(self):
+            self.conn = Conn()
+            self.returned = []
+
+        def getconn(self):
+            return self.conn
+
+        def putconn(self, conn, close=False):
+            self.returned.append((conn, close))
+
+    pool = Pool()
+    client = cls(**CONFIG, pool=pool)
+    client.release(client.connect())
+    assert pool.returned == [(pool.conn, False)]
+
+
+def test_reports_share_pool_with_valuation():
+    pool = object()
+    reports = ReportsCRUD(**CONFIG, pool=pool)
+    assert reports.pool is pool
+    assert reports.valuation.pool is pool
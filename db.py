@@ -1,26 +1,157 @@
 import os
+import threading
 from dotenv import load_dotenv
-from inventory_crud_pg import InventoryCRUD
 
-load_dotenv()
+# Everything below is built on first use so importing this module (and app.py)
+# never touches the network or the database.
+_lock = threading.RLock()
+_config = None
+_pool = None
+_crud = None
+_reports = None
+_code_index = None
+_jobs = None
 
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = os.getenv("DB_NAME", "carols_ims")
-DB_USER = os.getenv("DB_USER", "ims_user")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "password123")
 
-print(f"Database config: host={DB_HOST}, db={DB_NAME}, user={DB_USER}")
-crud = InventoryCRUD(
-    host=DB_HOST,
-    database=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD
-)
+class DatabaseClient:
+    """Base for classes that talk to the database: connect() hands out a
+    pooled connection when a pool is given, else opens a new one, and
+    release() gives it back. The pool rolls back any open transaction."""
 
-connect = crud.connect
+    def __init__(self, host, database, user, password, pool=None):
+        self.config = {
+            "host": host,
+            "database": database,
+            "user": user,
+            "password": password
+        }
+        self.pool = pool
 
+    def connect(self):
+        if self.pool is not None:
+            return self.pool.getconn()
+        import psycopg2
+        return psycopg2.connect(**self.config)
 
+    def release(self, conn):
+        if self.pool is not None:
+            self.pool.putconn(conn, close=bool(conn.closed))
+        else:
+            conn.close()
 
-add_product = crud.add_product
-update_product = crud.update_product
-delete_product = crud.delete_product
+
+def get_config():
+    """Read database settings from the environment / .env once"""
+    global _config
+    if _config is None:
+        load_dotenv()
+        _config = {
+            "host": os.getenv("DB_HOST", "localhost"),
+            "database": os.getenv("DB_NAME", "carols_ims"),
+            "user": os.getenv("DB_USER", "ims_user"),
+            "password": os.getenv("DB_PASSWORD", "password123"),
+        }
+    return _config
+
+
+def get_pool():
+    """Return the shared connection pool, creating it on first call"""
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+
+                config = get_config()
+                print(f"Database config: host={config['host']}, db={config['database']}, user={config['user']}")
+                _pool = ThreadedConnectionPool(
+                    int(os.getenv("DB_POOL_MIN", 1)),
+                    int(os.getenv("DB_POOL_MAX", 20)),
+                    connect_timeout=int(os.getenv("DB_CONNECT_TIMEOUT", 3)),
+                    **config
+                )
+    return _pool
+
+
+def get_crud():
+    global _crud
+    if _crud is None:
+        with _lock:
+            if _crud is None:
+                from inventory_crud_pg import InventoryCRUD
+                _crud = InventoryCRUD(**get_config(), pool=get_pool())
+    return _crud
+
+
+def get_reports():
+    global _reports
+    if _reports is None:
+        with _lock:
+            if _reports is None:
+                from reports_crud import ReportsCRUD
+                _reports = ReportsCRUD(**get_config(), pool=get_pool())
+    return _reports
+
+
+def get_code_index():
+    global _code_index
+    if _code_index is None:
+        with _lock:
+            if _code_index is None:
+                from product_code_index import ProductCodeIndex
+                _code_index = ProductCodeIndex(**get_config())
+    return _code_index
+
+
+def get_jobs():
+    global _jobs
+    if _jobs is None:
+        with _lock:
+            if _jobs is None:
+                from jobs import JobQueue, load_tasks
+                load_tasks()
+                _jobs = JobQueue(**get_config(), pool=get_pool())
+    return _jobs
+
+
+def test_db_connection():
+    """Check out a pooled connection and run a trivial query.
+    Returns (success, message)."""
+    try:
+        pool = get_pool()
+        conn = pool.getconn()
+    except Exception as e:
+        return False, f"Cannot connect to database: {str(e).strip()}"
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+        return True, "Database connection OK"
+    except Exception as e:
+        return False, f"Database query failed: {str(e).strip()}"
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+def close_pool():
+    global _pool, _crud, _reports, _jobs
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _crud = None
+            _reports = None
+            _jobs = None
+
+
+# Old module-level names (db.crud, db.connect, db.add_product, ...) resolve lazily
+def __getattr__(name):
+    if name == "crud":
+        return get_crud()
+    if name == "code_index":
+        return get_code_index()
+    if name in ("connect", "add_product", "update_product", "delete_product"):
+        return getattr(get_crud(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
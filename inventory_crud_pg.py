@@ -1,85 +1,156 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-class InventoryCRUD:
-    def __init__(self, host, database, user, password):
-        self.config = {
-            "host": host,
-            "database": database,
-            "user": user,
-            "password": password
-        }
-
-    def connect(self):
-        """Create and return a new database connection"""
-        return psycopg2.connect(**self.config)
-
-    def list_products(self, search_term="", limit=100):
-        """Get list of products with optional search"""
+import psycopg2.errors
+from psycopg2.extras import RealDictCursor, execute_values
+from db import DatabaseClient
+from json_rows import JSONArrayStream, fetch_json_array
+from prepared_statements import PRODUCT_COLUMNS, execute_statement, plain_params, plain_sql
+from product_audit import AUDITED_FIELDS, ProductAuditLog, diff
+
+# Stock changes made without a location go to this one
+MAIN_LOCATION = "MAIN"
+
+
+def main_location_id(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT id FROM locations WHERE code = %s", (MAIN_LOCATION,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"Location {MAIN_LOCATION} does not exist.")
+        return row[0]
+    finally:
+        cursor.close()
+
+
+def take_stock(conn, items, location_id=None, prepare=False):
+    """Decrement sold quantities inside the caller's open transaction.
+
+    items is an iterable of (product_id, quantity), taken from location_id
+    (the MAIN location when None). Raises ValueError when a
+    product is unavailable or short; the caller rolls back and nothing it did
+    on conn is kept. Returns {product_id: remaining quantity}.
+    """
+    totals = {}
+    for product_id, quantity in items:
+        if quantity <= 0:
+            raise ValueError("Sold quantity must be positive.")
+        totals[product_id] = totals.get(product_id, 0) + quantity
+
+    cursor = conn.cursor()
+    try:
+        remaining = {}
+        # Id order keeps concurrent checkouts from deadlocking on shared products
+        for product_id in sorted(totals):
+            execute_statement(cursor, "stock_decrement",
+                              (location_id, product_id, totals[product_id]), prepare=prepare)
+            row = cursor.fetchone()
+            if row is None:
+                raise ValueError(f"Product {product_id} is unavailable or has insufficient stock.")
+            remaining[product_id] = row[0]
+        return remaining
+    finally:
+        cursor.close()
+
+
+class InventoryCRUD(DatabaseClient):
+    def __init__(self, host, database, user, password, pool=None, audit=None):
+        # Optional psycopg2 pool; without one every call opens its own connection
+        super().__init__(host, database, user, password, pool)
+        # Before/after values of product changes, written in the background
+        self.audit = audit if audit is not None else ProductAuditLog(
+            host, database, user, password, pool=pool)
+
+    def execute(self, cursor, statement, params=()):
+        """Run a hot-path statement from the prepared statement registry.
+        Statements are only prepared on pooled (long-lived) connections."""
+        execute_statement(cursor, statement, params, prepare=self.pool is not None)
+
+    def _list_statement(self, search_term, limit, location_id):
+        """Registry statement name and parameters for a product list"""
+        if location_id is not None:
+            if search_term:
+                return "product_search_at_location", (location_id, f"%{search_term}%", limit)
+            return "product_list_at_location", (location_id, limit)
+        if search_term:
+            return "product_search", (f"%{search_term}%", limit)
+        return "product_list", (limit,)
+
+    def list_products(self, search_term="", limit=100, location_id=None):
+        """Get list of products with optional search.
+        With location_id, quantity is the stock held at that location."""
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         try:
-            if search_term:
-                sql = """
-                    SELECT 
-                        id, product_code, name, category_id, 
-                        price, current_quantity as quantity, 
-                        reorder_threshold, archived,
-                        created_by, last_updated_by,
-                        created_at, updated_at
-                    FROM products 
-                    WHERE name ILIKE %s 
-                    AND archived = FALSE 
-                    ORDER BY id 
-                    LIMIT %s
-                """
-                cursor.execute(sql, (f"%{search_term}%", limit))
-            else:
-                sql = """
-                    SELECT 
-                        id, product_code, name, category_id, 
-                        price, current_quantity as quantity, 
-                        reorder_threshold, archived,
-                        created_by, last_updated_by,
-                        created_at, updated_at
-                    FROM products 
-                    WHERE archived = FALSE 
-                    ORDER BY id 
-                    LIMIT %s
-                """
-                cursor.execute(sql, (limit,))
+            self.execute(cursor, *self._list_statement(search_term, limit, location_id))
             
             rows = cursor.fetchall()
             return rows
             
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
+
+    def list_products_json(self, search_term="", limit=100, location_id=None):
+        """Same rows as list_products, serialized to a JSON array by Postgres"""
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            statement, params = self._list_statement(search_term, limit, location_id)
+            return fetch_json_array(cursor, plain_sql(statement), plain_params(params))
+
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def stream_products_json(self, batch_rows=2000):
+        """Every active product as a JSON array, streamed in chunks.
+        The connection is held until the returned stream is closed."""
+        conn = self.connect()
+        return JSONArrayStream(
+            conn,
+            f"SELECT {PRODUCT_COLUMNS} FROM products WHERE archived = FALSE ORDER BY id",
+            release=self.release,
+            batch_rows=batch_rows
+        )
 
     def get_product(self, product_id):
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
+        try:
+            self.execute(cursor, "product_get_by_id", (product_id,))
+            product = cursor.fetchone()
+            return product
+            
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def get_product_by_code(self, product_code):
+        """Look up an active product by its product/barcode code"""
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
         try:
             sql = """
                 SELECT 
                     id, product_code, name, category_id, 
-                    price, current_quantity as quantity, 
+                    price, product_quantity(id, current_quantity) as quantity, 
                     reorder_threshold, archived,
                     created_by, last_updated_by,
                     created_at, updated_at
                 FROM products 
-                WHERE id = %s 
+                WHERE product_code = %s 
                 AND archived = FALSE
             """
-            cursor.execute(sql, (product_id,))
+            cursor.execute(sql, (product_code,))
             product = cursor.fetchone()
             return product
             
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
 
     def add_product(self, name, current_quantity, price,
                     category_id=None, product_code=None,
@@ -96,6 +167,8 @@ class InventoryCRUD:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
+            main_id = main_location_id(conn)
+
             # Check if product with same name already exists
             cursor.execute(
                 "SELECT id FROM products WHERE name = %s AND archived = FALSE",
@@ -104,27 +177,45 @@ class InventoryCRUD:
             if cursor.fetchone():
                 raise ValueError("A product with this name already exists.")
 
-            # SQL insert with RETURNING clause
+            # SQL insert with RETURNING clause; the opening stock goes into the
+            # MAIN location and reaches current_quantity through the fold
             sql = """
                 INSERT INTO products
-                (product_code, name, category_id, price, current_quantity,
+                (product_code, name, category_id, price,
                  reorder_threshold, created_by, last_updated_by)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id;
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, product_code, name, category_id, price,
+                          reorder_threshold,
+                          clock_timestamp()::timestamp AS changed_at;
             """
 
-            cursor.execute(sql, (
-                product_code, name, category_id, price, current_quantity,
-                reorder_threshold, created_by, created_by
-            ))
+            try:
+                cursor.execute(sql, (
+                    product_code, name, category_id, price,
+                    reorder_threshold, created_by, created_by
+                ))
+            except psycopg2.errors.UniqueViolation:
+                raise ValueError("A product with this code already exists.")
 
-            new_id = cursor.fetchone()["id"]
+            created = cursor.fetchone()
+            cursor.execute(
+                "INSERT INTO product_stock (location_id, product_id, quantity) VALUES (%s, %s, %s)",
+                (main_id, created["id"], current_quantity)
+            )
+            created["current_quantity"] = self._fold_products(conn, [created["id"]])[created["id"]]
             conn.commit()
-            return new_id
+
+            self.audit.record(
+                created["id"], "create",
+                {field: [None, created[field]] for field in AUDITED_FIELDS
+                 if created.get(field) is not None},
+                changed_by=created_by, changed_at=created["changed_at"]
+            )
+            return created["id"]
 
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
 
     def update_product(self, product_id,
                        name=None, current_quantity=None, price=None,
@@ -134,66 +225,69 @@ class InventoryCRUD:
         
         if not product_id:
             raise ValueError("Product ID is required.")
+        if current_quantity is not None and current_quantity < 0:
+            raise ValueError("Quantity cannot be negative.")
 
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
-            # Verify product exists and is not archived
-            cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
-            product = cursor.fetchone()
+            fields = (name, current_quantity, price, category_id, reorder_threshold)
 
-            if not product or product["archived"] is True:
-                raise ValueError("Product does not exist or is archived.")
+            # If no fields to update, return early (but still reject unknown products)
+            if all(value is None for value in fields):
+                self.execute(cursor, "product_get_by_id", (product_id,))
+                if not cursor.fetchone():
+                    raise ValueError("Product does not exist or is archived.")
+                return False
 
-            # Dynamic SQL building
-            updates = []
-            params = []
+            # Same statement text for every combination of fields; NULL keeps the old value
+            self.execute(cursor, "product_update", (
+                product_id, name, price, category_id, reorder_threshold, last_updated_by
+            ))
+            row = cursor.fetchone()
 
-            if name is not None:
-                updates.append("name = %s")
-                params.append(name)
+            if row is None:
+                raise ValueError("Product does not exist or is archived.")
 
             if current_quantity is not None:
-                updates.append("current_quantity = %s")
-                params.append(current_quantity)
+                # The quantity is a new total; it is set through the MAIN location
+                self._set_total_stock(conn, product_id, current_quantity)
+                row["current_quantity"] = self._fold_products(conn, [product_id])[product_id]
 
-            if price is not None:
-                updates.append("price = %s")
-                params.append(price)
-
-            if category_id is not None:
-                updates.append("category_id = %s")
-                params.append(category_id)
-
-            if reorder_threshold is not None:
-                updates.append("reorder_threshold = %s")
-                params.append(reorder_threshold)
+            conn.commit()
 
-            # If no fields to update, return early
-            if not updates:
-                return False
+            before = {field[4:]: value for field, value in row.items() if field.startswith("old_")}
+            self.audit.record(product_id, "update", diff(before, row),
+                              changed_by=last_updated_by, changed_at=row["changed_at"])
+            return True
 
-            # Add audit field
-            updates.append("last_updated_by = %s")
-            params.append(last_updated_by)
+        finally:
+            cursor.close()
+            self.release(conn)
 
-            params.append(product_id)  # WHERE clause parameter
+    def decrement_stock(self, items, location_id=None):
+        """Take sold quantities off stock atomically.
 
-            # Build dynamic UPDATE query
-            sql = f"""
-                UPDATE products
-                SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """
+        items is an iterable of (product_id, quantity). Either every product
+        has enough stock and all are decremented, or nothing changes and a
+        ValueError is raised. The stock is taken from location_id, or the MAIN
+        location without one; the product total follows via fold_stock_totals.
+        Returns {product_id: remaining quantity}.
+        """
+        conn = self.connect()
 
-            cursor.execute(sql, params)
+        try:
+            remaining = take_stock(conn, items, location_id, prepare=self.pool is not None)
             conn.commit()
-            return True
+            return remaining
+
+        except Exception:
+            conn.rollback()
+            raise
 
         finally:
-            cursor.close()
-            conn.close()
+            self.release(conn)
 
     def delete_product(self, product_id, last_updated_by=None, permanent=False):
         """Delete a product - soft delete (archive) by default"""
@@ -202,26 +296,285 @@ class InventoryCRUD:
             raise ValueError("Product ID is required.")
 
         conn = self.connect()
-        cursor = conn.cursor()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
             if permanent:
                 # Hard delete
-                cursor.execute("DELETE FROM products WHERE id = %s", (product_id,))
+                cursor.execute("""
+                    DELETE FROM products
+                    WHERE id = %s
+                    RETURNING product_code, name, category_id, price,
+                              product_quantity(id, current_quantity) AS current_quantity,
+                              reorder_threshold, archived,
+                              clock_timestamp()::timestamp AS changed_at
+                """, (product_id,))
             else:
                 # Soft delete (archive)
                 sql = """
-                    UPDATE products
+                    WITH before AS (
+                        SELECT id, archived FROM products WHERE id = %s FOR UPDATE
+                    )
+                    UPDATE products p
                     SET archived = TRUE,
                         last_updated_by = %s,
                         updated_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
+                    FROM before b
+                    WHERE p.id = b.id
+                    RETURNING b.archived AS was_archived,
+                              clock_timestamp()::timestamp AS changed_at
                 """
-                cursor.execute(sql, (last_updated_by, product_id))
+                cursor.execute(sql, (product_id, last_updated_by))
+            row = cursor.fetchone()
 
             conn.commit()
+
+            if row is not None and permanent:
+                self.audit.record(
+                    product_id, "delete",
+                    {field: [row[field], None] for field in AUDITED_FIELDS
+                     if row[field] is not None},
+                    changed_by=last_updated_by, changed_at=row["changed_at"]
+                )
+            elif row is not None and not row["was_archived"]:
+                self.audit.record(product_id, "archive", {"archived": [False, True]},
+                                  changed_by=last_updated_by, changed_at=row["changed_at"])
             return True
 
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
+
+    def adjust_stock_bulk(self, adjustments, last_updated_by=None,
+                          allow_negative=False, all_or_nothing=False,
+                          location_id=None, unit_costs=None):
+        """Apply relative quantity changes to many products in one transaction.
+
+        adjustments is an iterable of (product_id, delta) pairs; deltas for the
+        same product are summed. The stock rows of location_id (the MAIN
+        location without one) are changed with quantity + delta in a single
+        upsert, so concurrent sales are never overwritten, and the product
+        totals are folded before commit. unit_costs ({product_id: cost},
+        optional) records the purchase cost of a receipt on products.unit_cost,
+        which stock valuation uses for the movement. Returns one result dict
+        per product, ordered by product id. With location_id, quantity is the
+        stock at that location; without one it is the product total over all
+        locations (stock is still checked against MAIN). Either way it is the
+        new value for updated rows and the unchanged value for the rest.
+        """
+        deltas = {}
+        for product_id, delta in adjustments:
+            if not isinstance(product_id, int) or not isinstance(delta, int):
+                raise ValueError("Product ID and delta must be integers.")
+            deltas[product_id] = deltas.get(product_id, 0) + delta
+
+        if not deltas:
+            raise ValueError("At least one adjustment is required.")
+
+        product_ids = sorted(deltas)
+        unit_costs = unit_costs or {}
+
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            stock_location = location_id if location_id is not None else main_location_id(conn)
+            updated, existing, totals_before = self._adjust_location_stock(
+                cursor, deltas, product_ids, stock_location, last_updated_by,
+                allow_negative, unit_costs)
+
+            rolled_back = all_or_nothing and len(updated) < len(product_ids)
+            if location_id is None:
+                existing = {pid: totals_before[pid] for pid in existing}
+            if updated and not rolled_back:
+                totals = self._fold_products(conn, sorted(updated))
+                if location_id is None:
+                    updated = {pid: totals[pid] for pid in updated}
+
+            results = []
+            for pid in product_ids:
+                if pid in updated:
+                    results.append({"product_id": pid, "delta": deltas[pid],
+                                    "status": "updated", "quantity": updated[pid]})
+                elif pid in existing:
+                    results.append({"product_id": pid, "delta": deltas[pid],
+                                    "status": "insufficient_stock", "quantity": existing[pid]})
+                else:
+                    results.append({"product_id": pid, "delta": deltas[pid],
+                                    "status": "not_found", "quantity": None})
+
+            if rolled_back:
+                conn.rollback()
+                for result in results:
+                    if result["status"] == "updated":
+                        result["status"] = "rolled_back"
+                        if location_id is None:
+                            result["quantity"] = totals_before[result["product_id"]]
+                        else:
+                            result["quantity"] -= result["delta"]
+            else:
+                conn.commit()
+
+            return results
+
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def _adjust_location_stock(self, cursor, deltas, product_ids, location_id,
+                               last_updated_by, allow_negative, unit_costs):
+        # Lock in id order so two bulk adjustments (or an adjustment and the
+        # fold) cannot deadlock each other; keep the totals from before the change
+        cursor.execute("""
+            SELECT id, product_quantity(id, current_quantity) FROM products
+            WHERE id = ANY(%s) ORDER BY id FOR UPDATE
+        """, (product_ids,))
+        totals_before = dict(cursor.fetchall())
+
+        # Received stock carries its purchase cost into the stock movement,
+        # so the cost has to be in place before the stock rows change
+        received = [(pid, unit_costs[pid]) for pid in product_ids
+                    if deltas[pid] > 0 and unit_costs.get(pid) is not None]
+        if received:
+            execute_values(cursor, """
+                UPDATE products p
+                SET unit_cost = v.unit_cost
+                FROM (VALUES %s) AS v(id, unit_cost)
+                WHERE p.id = v.id
+                AND p.archived = FALSE
+            """, received, template="(%s::int, %s::numeric)", page_size=len(received))
+
+        cursor.execute(
+            """
+            SELECT product_id FROM product_stock
+            WHERE location_id = %s AND product_id = ANY(%s)
+            ORDER BY product_id FOR UPDATE
+            """,
+            (location_id, product_ids)
+        )
+
+        # Only this location's stock rows are touched; products.current_quantity
+        # catches up through the fold
+        sql = """
+            INSERT INTO product_stock (location_id, product_id, quantity)
+            SELECT v.location_id, v.id, v.delta
+            FROM (VALUES %s) AS v(id, delta, location_id, allow_negative)
+            JOIN products p ON p.id = v.id AND p.archived = FALSE
+            LEFT JOIN product_stock ps ON ps.location_id = v.location_id AND ps.product_id = v.id
+            WHERE v.allow_negative OR COALESCE(ps.quantity, 0) + v.delta >= 0
+            ON CONFLICT (location_id, product_id) DO UPDATE
+            SET quantity = product_stock.quantity + EXCLUDED.quantity,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING product_id, quantity
+        """
+        try:
+            updated = dict(execute_values(
+                cursor, sql,
+                [(pid, deltas[pid], location_id, allow_negative) for pid in product_ids],
+                template="(%s::int, %s::int, %s::int, %s::boolean)",
+                page_size=len(product_ids),
+                fetch=True
+            ))
+        except psycopg2.errors.ForeignKeyViolation:
+            raise ValueError("Location does not exist.")
+
+        if updated and last_updated_by is not None:
+            cursor.execute("""
+                UPDATE products
+                SET last_updated_by = %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ANY(%s)
+            """, (last_updated_by, sorted(updated)))
+
+        skipped = [pid for pid in product_ids if pid not in updated]
+        existing = {}
+        if skipped:
+            cursor.execute(
+                """
+                SELECT p.id, COALESCE(ps.quantity, 0)
+                FROM products p
+                LEFT JOIN product_stock ps ON ps.location_id = %s AND ps.product_id = p.id
+                WHERE p.id = ANY(%s) AND p.archived = FALSE
+                """,
+                (location_id, skipped)
+            )
+            existing = dict(cursor.fetchall())
+
+        return updated, existing, totals_before
+
+    def _set_total_stock(self, conn, product_id, quantity):
+        """Make the product's total quantity over all locations equal quantity
+        by setting its MAIN stock. Other locations are left alone."""
+        main_id = main_location_id(conn)
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("""
+                SELECT location_id, quantity FROM product_stock
+                WHERE product_id = %s
+                ORDER BY location_id FOR UPDATE
+            """, (product_id,))
+            elsewhere = sum(qty for loc, qty in cursor.fetchall() if loc != main_id)
+            if quantity < elsewhere:
+                raise ValueError(
+                    f"Quantity cannot be below the {elsewhere} units held at other locations.")
+
+            cursor.execute("""
+                INSERT INTO product_stock (location_id, product_id, quantity)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (location_id, product_id) DO UPDATE
+                SET quantity = EXCLUDED.quantity,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (main_id, product_id, quantity - elsewhere))
+
+        finally:
+            cursor.close()
+
+    def _fold_products(self, conn, product_ids):
+        """Fold pending stock changes of just these products inside the open
+        transaction; returns {product_id: current_quantity}"""
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("SELECT fold_product_stock_totals(%s)", (product_ids,))
+            cursor.execute(
+                "SELECT id, current_quantity FROM products WHERE id = ANY(%s)",
+                (product_ids,)
+            )
+            return dict(cursor.fetchall())
+
+        finally:
+            cursor.close()
+
+    def fold_stock_totals(self):
+        """Fold pending per-location stock changes into products.current_quantity.
+        Returns the number of products whose total changed."""
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("SELECT fold_product_stock_totals()")
+            changed = cursor.fetchone()[0]
+            conn.commit()
+            return changed
+
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def list_locations(self):
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        try:
+            cursor.execute("""
+                SELECT id, code, name, location_type
+                FROM locations
+                WHERE archived = FALSE
+                ORDER BY id
+            """)
+            return cursor.fetchall()
+
+        finally:
+            cursor.close()
+            self.release(conn)
@@ -0,0 +1,341 @@
+"""Point-in-time stock valuation from month-end snapshots plus stock movements.
+
+Every change to product_stock is logged in stock_movements when it happens,
+with the unit cost at the time (products.unit_cost, which a goods receipt
+sets to its purchase cost, falling back to price). A
+month-end snapshot stores each product's quantity, weighted-average cost and
+remaining FIFO layers, plus one row of totals per period. The stock at any
+moment is then the latest earlier snapshot with the movements after it
+replayed on top, so only the movements since that snapshot are read.
+
+Run at the start of each month to store the previous month-end:
+
+    python inventory_valuation.py --snapshot
+"""
+import argparse
+import calendar
+import json
+from collections import deque
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from db import DatabaseClient, get_config
+
+METHODS = ("weighted_average", "fifo")
+
+CENTS = Decimal("0.01")
+COST_PLACES = Decimal("0.0001")
+
+
+def month_end(year, month):
+    return date(year, month, calendar.monthrange(year, month)[1])
+
+
+def previous_month(today=None):
+    """(year, month) of the last month that has fully ended"""
+    first = (today or date.today()).replace(day=1)
+    last = first - timedelta(days=1)
+    return last.year, last.month
+
+
+class CostLedger:
+    """Running quantity, weighted-average cost and FIFO layers of one product"""
+
+    __slots__ = ("quantity", "avg_cost", "layers")
+
+    def __init__(self, quantity=0, avg_cost=Decimal(0), layers=()):
+        self.quantity = quantity
+        self.avg_cost = avg_cost
+        self.layers = deque([qty, Decimal(cost)] for qty, cost in layers)
+
+    def apply(self, delta, unit_cost):
+        if delta > 0:
+            self.receive(delta, unit_cost)
+        elif delta < 0:
+            self.issue(-delta)
+
+    def receive(self, quantity, unit_cost):
+        on_hand = max(self.quantity, 0)
+        # Stock sold while the count was negative is covered first
+        layer = min(quantity, self.quantity + quantity)
+
+        if on_hand + layer > 0:
+            self.avg_cost = (self.avg_cost * on_hand + unit_cost * layer) / (on_hand + layer)
+        if layer > 0:
+            self.layers.append([layer, unit_cost])
+        self.quantity += quantity
+
+    def issue(self, quantity):
+        self.quantity -= quantity
+        while quantity and self.layers:
+            oldest = self.layers[0]
+            if oldest[0] <= quantity:
+                quantity -= oldest[0]
+                self.layers.popleft()
+            else:
+                oldest[0] -= quantity
+                quantity = 0
+
+    def avg_value(self):
+        return (self.avg_cost * self.quantity).quantize(CENTS)
+
+    def fifo_value(self):
+        return sum((qty * cost for qty, cost in self.layers), Decimal(0)).quantize(CENTS)
+
+    def value(self, method):
+        return self.fifo_value() if method == "fifo" else self.avg_value()
+
+
+class InventoryValuation(DatabaseClient):
+    # ---------------------------------------------------------
+    # Snapshots
+    # ---------------------------------------------------------
+    def take_month_end_snapshot(self, year, month, replace=False):
+        """Store the valuation at the end of year/month and return its totals.
+        An existing snapshot is returned as-is unless replace is set."""
+        period_end = month_end(year, month)
+        cutoff = datetime.combine(period_end + timedelta(days=1), datetime.min.time())
+
+        if cutoff > datetime.now():
+            raise ValueError("Period has not ended yet.")
+
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        try:
+            # Serialise snapshot writers so a period is never built twice at once
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('inventory_snapshots'))")
+
+            existing = self._period_totals(cursor, period_end)
+            if existing and not replace:
+                conn.rollback()
+                return existing
+
+            ledgers, _ = self._ledgers_at(conn, cutoff)
+
+            cursor.execute("DELETE FROM inventory_snapshots WHERE period_end = %s", (period_end,))
+            cursor.execute("DELETE FROM inventory_valuation_periods WHERE period_end = %s", (period_end,))
+
+            rows = [
+                (period_end, pid, ledger.quantity, ledger.avg_cost.quantize(COST_PLACES),
+                 json.dumps([[qty, str(cost)] for qty, cost in ledger.layers]),
+                 ledger.avg_value(), ledger.fifo_value())
+                for pid, ledger in sorted(ledgers.items()) if ledger.quantity != 0
+            ]
+            execute_values(cursor, """
+                INSERT INTO inventory_snapshots
+                (period_end, product_id, quantity, avg_unit_cost, fifo_layers, avg_value, fifo_value)
+                VALUES %s
+            """, rows)
+
+            cursor.execute("""
+                INSERT INTO inventory_valuation_periods
+                (period_end, total_quantity, avg_value, fifo_value, product_count)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING period_end, total_quantity, avg_value, fifo_value,
+                          product_count, created_at
+            """, (
+                period_end,
+                sum(row[2] for row in rows),
+                sum((row[5] for row in rows), Decimal(0)),
+                sum((row[6] for row in rows), Decimal(0)),
+                len(rows)
+            ))
+            totals = cursor.fetchone()
+            conn.commit()
+            return totals
+
+        except Exception:
+            conn.rollback()
+            raise
+
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def period_totals(self, period_end):
+        """Stored totals for one month-end (a single-row read), or None"""
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        try:
+            return self._period_totals(cursor, period_end)
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def _period_totals(self, cursor, period_end):
+        cursor.execute("""
+            SELECT period_end, total_quantity, avg_value, fifo_value,
+                   product_count, created_at
+            FROM inventory_valuation_periods
+            WHERE period_end = %s
+        """, (period_end,))
+        return cursor.fetchone()
+
+    # ---------------------------------------------------------
+    # Valuation
+    # ---------------------------------------------------------
+    def month_valuation(self, year, month, method="weighted_average"):
+        """Valuation at the end of year/month. Ended months are read from
+        their snapshot (taken now if missing); the running month is valued
+        as of now."""
+        period_end = month_end(year, month)
+
+        if datetime.combine(period_end + timedelta(days=1), datetime.min.time()) > datetime.now():
+            valuation = self.valuation_at(datetime.now(), method)
+        else:
+            if self.period_totals(period_end) is None:
+                self.take_month_end_snapshot(year, month)
+            valuation = self.valuation_at(period_end, method)
+
+        valuation["period_end"] = period_end
+        return valuation
+
+    def valuation_at(self, as_of, method="weighted_average"):
+        """Value stock at a point in time. A date means the end of that day.
+
+        Returns the per-product quantity, unit cost and value plus totals.
+        When as_of is a stored month-end the snapshot is returned directly.
+        """
+        if method not in METHODS:
+            raise ValueError(f"Valuation method must be one of: {', '.join(METHODS)}")
+
+        if isinstance(as_of, datetime):
+            cutoff = as_of
+        elif isinstance(as_of, date):
+            cutoff = datetime.combine(as_of + timedelta(days=1), datetime.min.time())
+        else:
+            raise ValueError("as_of must be a date or datetime.")
+
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        try:
+            if not isinstance(as_of, datetime):
+                totals = self._period_totals(cursor, as_of)
+                if totals:
+                    return self._stored_valuation(cursor, totals, method)
+
+            ledgers, based_on = self._ledgers_at(conn, cutoff)
+            products = []
+            for pid, ledger in sorted(ledgers.items()):
+                if ledger.quantity == 0:
+                    continue
+                value = ledger.value(method)
+                products.append({
+                    "product_id": pid,
+                    "quantity": ledger.quantity,
+                    "unit_cost": (value / ledger.quantity).quantize(COST_PLACES),
+                    "stock_value": value
+                })
+
+            return {
+                "as_of": as_of,
+                "method": method,
+                "source": "replay",
+                "based_on_snapshot": based_on,
+                "total_quantity": sum(p["quantity"] for p in products),
+                "total_value": sum((p["stock_value"] for p in products), Decimal(0)),
+                "products": products
+            }
+
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def _stored_valuation(self, cursor, totals, method):
+        value_column = "fifo_value" if method == "fifo" else "avg_value"
+        cursor.execute(f"""
+            SELECT product_id, quantity,
+                   ROUND({value_column} / quantity, 4) AS unit_cost,
+                   {value_column} AS stock_value
+            FROM inventory_snapshots
+            WHERE period_end = %s
+            ORDER BY product_id
+        """, (totals["period_end"],))
+
+        return {
+            "as_of": totals["period_end"],
+            "method": method,
+            "source": "snapshot",
+            "based_on_snapshot": totals["period_end"],
+            "total_quantity": totals["total_quantity"],
+            "total_value": totals[value_column],
+            "products": cursor.fetchall()
+        }
+
+    def _ledgers_at(self, conn, cutoff):
+        """Cost ledgers for every product as of cutoff (exclusive), starting
+        from the latest snapshot that ends on or before it"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT MAX(period_end)
+                FROM inventory_valuation_periods
+                WHERE period_end + 1 <= %s
+            """, (cutoff,))
+            based_on = cursor.fetchone()[0]
+
+            ledgers = {}
+            start = datetime.min
+            if based_on is not None:
+                cursor.execute("""
+                    SELECT product_id, quantity, avg_unit_cost, fifo_layers
+                    FROM inventory_snapshots
+                    WHERE period_end = %s
+                """, (based_on,))
+                for pid, quantity, avg_cost, layers in cursor.fetchall():
+                    ledgers[pid] = CostLedger(quantity, avg_cost, layers)
+                start = datetime.combine(based_on + timedelta(days=1), datetime.min.time())
+        finally:
+            cursor.close()
+
+        movements = conn.cursor(name="stock_movements_replay")
+        movements.itersize = 10000
+        try:
+            movements.execute("""
+                SELECT product_id, quantity, unit_cost
+                FROM stock_movements
+                WHERE moved_at >= %s AND moved_at < %s
+                ORDER BY moved_at, id
+            """, (start, cutoff))
+            for pid, delta, unit_cost in movements:
+                ledger = ledgers.get(pid)
+                if ledger is None:
+                    ledger = ledgers[pid] = CostLedger()
+                ledger.apply(delta, unit_cost)
+        finally:
+            movements.close()
+
+        return ledgers, based_on
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store month-end valuation snapshots")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="store the snapshot for the last ended month (or --year/--month)")
+    parser.add_argument("--year", type=int)
+    parser.add_argument("--month", type=int)
+    parser.add_argument("--replace", action="store_true", help="rebuild an existing snapshot")
+    args = parser.parse_args()
+
+    valuation = InventoryValuation(**get_config())
+
+    year, month = previous_month()
+    if args.year and args.month:
+        year, month = args.year, args.month
+
+    if args.snapshot:
+        totals = valuation.take_month_end_snapshot(year, month, replace=args.replace)
+    else:
+        totals = valuation.period_totals(month_end(year, month))
+
+    if totals is None:
+        print(f"No snapshot for {month_end(year, month)}")
+    else:
+        print(f"{totals['period_end']}: {totals['product_count']} products, "
+              f"{totals['total_quantity']} units, weighted average {totals['avg_value']}, "
+              f"FIFO {totals['fifo_value']}")
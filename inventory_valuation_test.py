@@ -0,0 +1,65 @@
+"""CostLedger: weighted-average cost and FIFO layers, no database needed"""
+from decimal import Decimal
+
+from inventory_valuation import CostLedger
+
+
+def test_receive_averages_cost():
+    ledger = CostLedger()
+    ledger.receive(10, Decimal("2.00"))
+    ledger.receive(10, Decimal("4.00"))
+    assert ledger.quantity == 20
+    assert ledger.avg_cost == Decimal("3.00")
+    assert ledger.avg_value() == Decimal("60.00")
+    assert ledger.fifo_value() == Decimal("60.00")
+
+
+def test_issue_consumes_oldest_layers_first():
+    ledger = CostLedger()
+    ledger.receive(10, Decimal("2.00"))
+    ledger.receive(10, Decimal("4.00"))
+    ledger.issue(15)
+    assert ledger.quantity == 5
+    assert [list(layer) for layer in ledger.layers] == [[5, Decimal("4.00")]]
+    assert ledger.fifo_value() == Decimal("20.00")
+    # Issues leave the average cost unchanged
+    assert ledger.avg_cost == Decimal("3.00")
+    assert ledger.avg_value() == Decimal("15.00")
+
+
+def test_apply_routes_by_sign():
+    ledger = CostLedger()
+    ledger.apply(4, Decimal("1.50"))
+    ledger.apply(-1, Decimal("9.99"))
+    ledger.apply(0, Decimal("9.99"))
+    assert ledger.quantity == 3
+    assert ledger.fifo_value() == Decimal("4.50")
+
+
+def test_receipt_first_covers_negative_stock():
+    ledger = CostLedger()
+    ledger.issue(3)
+    assert ledger.quantity == -3
+    assert not ledger.layers
+    ledger.receive(5, Decimal("2.00"))
+    assert ledger.quantity == 2
+    assert [list(layer) for layer in ledger.layers] == [[2, Decimal("2.00")]]
+    assert ledger.avg_cost == Decimal("2.00")
+    assert ledger.fifo_value() == Decimal("4.00")
+
+
+def test_receipt_that_leaves_stock_negative_adds_no_layer():
+    ledger = CostLedger()
+    ledger.issue(5)
+    ledger.receive(2, Decimal("2.00"))
+    assert ledger.quantity == -3
+    assert not ledger.layers
+    assert ledger.avg_cost == Decimal(0)
+
+
+def test_ledger_resumes_from_snapshot_layers():
+    ledger = CostLedger(6, Decimal("2.5"), [[2, "2.00"], [4, "2.75"]])
+    ledger.issue(3)
+    assert [list(layer) for layer in ledger.layers] == [[3, Decimal("2.75")]]
+    assert ledger.value("fifo") == Decimal("8.25")
+    assert ledger.value("weighted_average") == Decimal("7.50")
@@ -0,0 +1,51 @@
+"""Tasks run by the background worker (python jobs.py worker).
+
+Each task takes its job payload as keyword arguments and opens its own
+connections, since it runs in a separate worker process.
+"""
+from datetime import date
+
+from db import get_config
+from jobs import JobQueue, task
+
+
+@task("fold_stock_totals", max_concurrent=1, timeout=120)
+def fold_stock_totals():
+    from inventory_crud_pg import InventoryCRUD
+
+    return {"products_changed": InventoryCRUD(**get_config()).fold_stock_totals()}
+
+
+@task("reorder_forecast", max_concurrent=1, timeout=1800)
+def reorder_forecast(as_of=None, apply=False, window_days=90):
+    from reorder_forecast import ReorderForecast
+
+    forecast = ReorderForecast(**get_config(), window_days=window_days)
+    return forecast.run(as_of=date.fromisoformat(as_of) if as_of else None, apply=apply)
+
+
+@task("month_end_snapshot", max_concurrent=1, timeout=1800)
+def month_end_snapshot(year=None, month=None, replace=False):
+    """Store the valuation snapshot for the last ended month (or year/month).
+    Safe to schedule daily: an existing snapshot is left alone."""
+    from inventory_valuation import InventoryValuation, previous_month
+
+    if year is None or month is None:
+        year, month = previous_month()
+    return InventoryValuation(**get_config()).take_month_end_snapshot(year, month, replace)
+
+
+@task("monthly_inventory_report", timeout=600)
+def monthly_inventory_report(year=None, month=None, method="weighted_average"):
+    from reports_crud import ReportsCRUD
+
+    report = ReportsCRUD(**get_config()).monthly_inventory_report(year, month, method)
+    # The job result keeps the totals; the rows stay queryable via the report API
+    report.pop("products")
+    report.pop("low_stock_items")
+    return report
+
+
+@task("prune_jobs", max_concurrent=1, timeout=300)
+def prune_jobs(keep_days=30):
+    return {"jobs_deleted": JobQueue(**get_config()).prune(keep_days)}
@@ -0,0 +1,580 @@
+"""Postgres-backed background jobs.
+
+Jobs live in the jobs table. Workers claim them with FOR UPDATE SKIP LOCKED,
+so any number of worker processes (on one machine or several) can share the
+queue without handing the same job out twice. Each worker runs claimed jobs
+in a process pool, so CPU-heavy tasks use every core and never block the
+Flask request path.
+
+    from jobs import JobQueue
+    JobQueue(**get_config()).enqueue("reorder_forecast", {"apply": True})
+
+Start a worker (tasks are registered in job_tasks.py):
+
+    python jobs.py worker --concurrency 4
+
+A job's timeout is enforced with SIGALRM and, for the queries it runs, as
+statement_timeout on every connection the task opens. Failed jobs are
+retried with exponential backoff up to max_attempts. Every
+attempt is recorded in job_runs with its queue wait and run time, which
+metrics() summarises per task. Recurring work is declared in job_schedules.
+"""
+import argparse
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import Json, RealDictCursor
+
+from db import DatabaseClient
+
+CHANNEL = "jobs"
+
+# Modules whose @task functions are loaded by every worker process
+TASK_MODULES = ["job_tasks"]
+
+# task name -> {"func", "max_concurrent", "timeout", "max_attempts"}
+REGISTRY = {}
+
+
+def task(name, max_concurrent=None, timeout=600, max_attempts=3):
+    """Register a function as a job task. It is called with the job payload
+    as keyword arguments; its return value must be JSON serialisable
+    (dates and decimals are stored as strings)."""
+    def register(func):
+        REGISTRY[name] = {
+            "func": func,
+            "max_concurrent": max_concurrent,
+            "timeout": timeout,
+            "max_attempts": max_attempts
+        }
+        return func
+    return register
+
+
+def load_tasks(modules=None):
+    for module in modules or TASK_MODULES:
+        importlib.import_module(module)
+    return REGISTRY
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class JobQueue(DatabaseClient):
+    def __init__(self, host, database, user, password, pool=None,
+                 retry_base_seconds=30, retry_max_seconds=3600):
+        super().__init__(host, database, user, password, pool)
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+
+    def _run(self, sql, params=(), fetch="one"):
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        try:
+            cursor.execute(sql, params)
+            if fetch == "one":
+                result = cursor.fetchone()
+            elif fetch == "all":
+                result = cursor.fetchall()
+            else:
+                result = cursor.rowcount
+            conn.commit()
+            return result
+
+        except Exception:
+            conn.rollback()
+            raise
+
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    # ---------------------- PRODUCERS ----------------------
+    def enqueue(self, task_name, payload=None, run_at=None, priority=0,
+                max_attempts=None, timeout=None):
+        """Queue a job and wake idle workers. Returns the job id.
+        run_at (a datetime) delays the job; higher priority runs first."""
+        if not task_name:
+            raise ValueError("Task name is required.")
+
+        row = self._run("""
+            WITH queued AS (
+                INSERT INTO jobs (task, payload, run_at, priority, max_attempts, timeout_seconds)
+                VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP), %s, %s, %s)
+                RETURNING id
+            )
+            SELECT id, pg_notify(%s, %s) FROM queued
+        """, (
+            task_name, Json(payload or {}), run_at, priority, max_attempts, timeout,
+            CHANNEL, task_name
+        ))
+        return row["id"]
+
+    def get_job(self, job_id):
+        return self._run("""
+            SELECT id, task, payload, status, priority, run_at, attempts,
+                   max_attempts, schedule_name, worker, result, last_error,
+                   created_at, started_at, finished_at
+            FROM jobs
+            WHERE id = %s
+        """, (job_id,))
+
+    def schedule(self, name, task_name, interval_seconds, payload=None, enabled=True):
+        """Create or change a recurring job; it first runs on the next worker tick"""
+        if interval_seconds <= 0:
+            raise ValueError("Interval must be a positive number of seconds.")
+
+        return self._run("""
+            INSERT INTO job_schedules (name, task, payload, interval_seconds, enabled)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (name) DO UPDATE
+            SET task = EXCLUDED.task,
+                payload = EXCLUDED.payload,
+                interval_seconds = EXCLUDED.interval_seconds,
+                enabled = EXCLUDED.enabled
+            RETURNING name, task, payload, interval_seconds, next_run_at, enabled
+        """, (name, task_name, Json(payload or {}), interval_seconds, enabled))
+
+    # ---------------------- WORKERS ----------------------
+    def enqueue_due_schedules(self):
+        """Queue one job per due schedule and move its next run forward.
+        A schedule whose previous job is still pending is skipped."""
+        rows = self._run("""
+            WITH due AS (
+                SELECT name
+                FROM job_schedules
+                WHERE enabled = TRUE
+                AND next_run_at <= CURRENT_TIMESTAMP
+                FOR UPDATE SKIP LOCKED
+            ), advanced AS (
+                UPDATE job_schedules s
+                SET next_run_at = CURRENT_TIMESTAMP + make_interval(secs => s.interval_seconds)
+                FROM due
+                WHERE s.name = due.name
+                RETURNING s.name, s.task, s.payload
+            )
+            INSERT INTO jobs (task, payload, schedule_name)
+            SELECT a.task, a.payload, a.name
+            FROM advanced a
+            WHERE NOT EXISTS (
+                SELECT 1 FROM jobs j
+                WHERE j.schedule_name = a.name
+                AND j.status IN ('queued', 'running')
+            )
+            RETURNING id
+        """, fetch="all")
+        return len(rows)
+
+    def claim(self, worker, limit, exclude_tasks=(), defaults=None):
+        """Mark up to limit due jobs as running for this worker and return them.
+        Rows locked by another worker's claim are skipped, not waited on.
+        defaults ({task: {"timeout": s, "max_attempts": n}}) fills in the
+        limits of jobs queued without their own."""
+        return self._run("""
+            UPDATE jobs j
+            SET status = 'running',
+                attempts = j.attempts + 1,
+                timeout_seconds = COALESCE(
+                    j.timeout_seconds, (%s::jsonb -> j.task ->> 'timeout')::int, 600),
+                max_attempts = COALESCE(
+                    j.max_attempts, (%s::jsonb -> j.task ->> 'max_attempts')::int, 3),
+                worker = %s,
+                started_at = CURRENT_TIMESTAMP,
+                heartbeat_at = CURRENT_TIMESTAMP,
+                finished_at = NULL
+            FROM (
+                SELECT id
+                FROM jobs
+                WHERE status = 'queued'
+                AND run_at <= CURRENT_TIMESTAMP
+                AND task <> ALL(%s)
+                ORDER BY priority DESC, run_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) next_jobs
+            WHERE j.id = next_jobs.id
+            RETURNING j.id, j.task, j.payload, j.attempts, j.max_attempts,
+                      j.timeout_seconds,
+                      (EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - j.run_at)) * 1000)::int AS wait_ms
+        """, (Json(defaults or {}), Json(defaults or {}), worker, list(exclude_tasks), limit),
+            fetch="all")
+
+    def running_counts(self):
+        """Running jobs per task across all workers"""
+        rows = self._run("""
+            SELECT task, COUNT(*) AS running
+            FROM jobs
+            WHERE status = 'running'
+            GROUP BY task
+        """, fetch="all")
+        return {row["task"]: row["running"] for row in rows}
+
+    def unclaim(self, job, worker):
+        """Put a claimed job back without counting the attempt"""
+        self._run("""
+            UPDATE jobs
+            SET status = 'queued', attempts = attempts - 1, worker = NULL, started_at = NULL
+            WHERE id = %s AND status = 'running' AND worker = %s
+        """, (job["id"], worker), fetch=None)
+
+    def complete(self, job, worker, duration_ms, result=None):
+        self._run("""
+            WITH done AS (
+                UPDATE jobs
+                SET status = 'succeeded',
+                    result = %s,
+                    last_error = NULL,
+                    finished_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND status = 'running' AND worker = %s
+                RETURNING id
+            )
+            INSERT INTO job_runs (job_id, task, attempt, worker, status, wait_ms, duration_ms)
+            SELECT id, %s, %s, %s, 'succeeded', %s, %s FROM done
+        """, (Json(result), job["id"], worker,
+              job["task"], job["attempts"], worker, job["wait_ms"], duration_ms),
+            fetch=None)
+
+    def fail(self, job, worker, duration_ms, error):
+        """Record a failed attempt; requeue with backoff while attempts remain.
+        Returns the job's new status."""
+        row = self._run("""
+            WITH failed AS (
+                UPDATE jobs
+                SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                    run_at = CASE WHEN attempts < max_attempts
+                        THEN CURRENT_TIMESTAMP + make_interval(
+                            secs => LEAST(%s * power(2, attempts - 1), %s))
+                        ELSE run_at END,
+                    last_error = %s,
+                    finished_at = CASE WHEN attempts < max_attempts
+                        THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = %s AND status = 'running' AND worker = %s
+                RETURNING id, status
+            ), logged AS (
+                INSERT INTO job_runs (job_id, task, attempt, worker, status, wait_ms, duration_ms, error)
+                SELECT id, %s, %s, %s, 'failed', %s, %s, %s FROM failed
+            )
+            SELECT status FROM failed
+        """, (self.retry_base_seconds, self.retry_max_seconds, error, job["id"], worker,
+              job["task"], job["attempts"], worker, job["wait_ms"], duration_ms, error))
+        return row["status"] if row else None
+
+    def heartbeat(self, worker):
+        """Mark this worker's running jobs as still being worked on"""
+        return self._run("""
+            UPDATE jobs
+            SET heartbeat_at = CURRENT_TIMESTAMP
+            WHERE worker = %s AND status = 'running'
+        """, (worker,), fetch=None)
+
+    def requeue_stale(self, grace_seconds=90):
+        """Give back jobs whose worker died: no heartbeat for grace_seconds.
+        Jobs of a live worker are never taken, however long they run."""
+        return self._run("""
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                run_at = CURRENT_TIMESTAMP,
+                last_error = 'Worker stopped responding before the job finished',
+                finished_at = CASE WHEN attempts < max_attempts
+                    THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE status = 'running'
+            AND COALESCE(heartbeat_at, started_at) + make_interval(secs => %s) < CURRENT_TIMESTAMP
+        """, (grace_seconds,), fetch=None)
+
+    def prune(self, keep_days=30):
+        """Delete finished jobs and run timings older than keep_days"""
+        deleted = self._run("""
+            DELETE FROM jobs
+            WHERE status IN ('succeeded', 'failed')
+            AND finished_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+        """, (keep_days,), fetch=None)
+        self._run("""
+            DELETE FROM job_runs
+            WHERE finished_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+        """, (keep_days,), fetch=None)
+        return deleted
+
+    # ---------------------- METRICS ----------------------
+    def metrics(self, since_seconds=86400):
+        """Per-task attempt counts and timings over the last since_seconds,
+        plus the current queue depth"""
+        tasks = self._run("""
+            SELECT task,
+                   COUNT(*) AS attempts,
+                   COUNT(*) FILTER (WHERE status = 'succeeded') AS succeeded,
+                   COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                   ROUND(AVG(duration_ms)) AS avg_duration_ms,
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY duration_ms) AS p95_duration_ms,
+                   MAX(duration_ms) AS max_duration_ms,
+                   ROUND(AVG(wait_ms)) AS avg_wait_ms,
+                   MAX(wait_ms) AS max_wait_ms
+            FROM job_runs
+            WHERE finished_at >= CURRENT_TIMESTAMP - make_interval(secs => %s)
+            GROUP BY task
+            ORDER BY task
+        """, (since_seconds,), fetch="all")
+
+        queue = self._run("""
+            SELECT task,
+                   COUNT(*) FILTER (WHERE status = 'queued') AS queued,
+                   COUNT(*) FILTER (WHERE status = 'running') AS running,
+                   COUNT(*) FILTER (WHERE status = 'queued'
+                                    AND run_at <= CURRENT_TIMESTAMP) AS due
+            FROM jobs
+            WHERE status IN ('queued', 'running')
+            GROUP BY task
+            ORDER BY task
+        """, fetch="all")
+
+        return {"since_seconds": since_seconds, "tasks": tasks, "queue": queue}
+
+
+# ---------------------- WORKER PROCESSES ----------------------
+def _init_child(modules):
+    # Ctrl-C goes to the parent, which drains the pool before exiting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_tasks(modules)
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _execute(task_name, payload, timeout):
+    """Run one task in a pool process.
+    Returns (ok, result or error text, duration in ms)."""
+    started = time.perf_counter()
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    pg_options = os.environ.get("PGOPTIONS")
+
+    try:
+        spec = REGISTRY.get(task_name)
+        if spec is None:
+            raise LookupError(f"Unknown task: {task_name}")
+
+        if timeout:
+            # SIGALRM is not acted on while a query blocks inside libpq, so
+            # connections opened by the task cap each statement as well
+            os.environ["PGOPTIONS"] = f"{pg_options or ''} -c statement_timeout={timeout * 1000}".strip()
+        if use_alarm:
+            signal.signal(signal.SIGALRM, _alarm)
+            signal.alarm(timeout)
+        try:
+            result = spec["func"](**payload)
+        finally:
+            if use_alarm:
+                signal.alarm(0)
+            if pg_options is None:
+                os.environ.pop("PGOPTIONS", None)
+            else:
+                os.environ["PGOPTIONS"] = pg_options
+
+        # Round-trip through JSON here so odd return types fail the job, not the worker
+        result = json.loads(json.dumps(result, default=str))
+        return True, result, int((time.perf_counter() - started) * 1000)
+
+    except (JobTimeout, psycopg2.extensions.QueryCanceledError):
+        error = f"Timed out after {timeout} seconds"
+    except Exception:
+        error = traceback.format_exc(limit=5)
+
+    return False, error, int((time.perf_counter() - started) * 1000)
+
+
+class JobWorker:
+    """Claims jobs and runs up to concurrency of them at once in child processes.
+
+    Per-task max_concurrent limits (see @task) count running jobs across all
+    workers sharing the queue.
+    """
+
+    def __init__(self, queue, concurrency=None, poll_interval=5.0,
+                 maintenance_interval=30.0, modules=None):
+        self.queue = queue
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.maintenance_interval = maintenance_interval
+        self.modules = modules or TASK_MODULES
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.running = {}  # future -> job row
+        self._stopping = False
+        self._executor = None
+        self._listen_conn = None
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def run(self):
+        load_tasks(self.modules)
+        self._executor = self._new_executor()
+        self._listen_conn = self._listen()
+        next_maintenance = 0.0
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"Worker {self.name}: {self.concurrency} processes, "
+              f"tasks: {', '.join(sorted(REGISTRY))}")
+
+        try:
+            while not self._stopping:
+                if time.monotonic() >= next_maintenance:
+                    self.queue.heartbeat(self.name)
+                    self.queue.enqueue_due_schedules()
+                    # A few missed heartbeats mean that worker is gone
+                    self.queue.requeue_stale(grace_seconds=3 * self.maintenance_interval)
+                    next_maintenance = time.monotonic() + self.maintenance_interval
+
+                self._collect(timeout=0)
+                claimed = self._claim()
+
+                if self._stopping or claimed:
+                    continue
+                if self.running:
+                    self._collect(timeout=min(0.5, self.poll_interval))
+                    self._drain_notifications()
+                else:
+                    self._wait_for_notification(self.poll_interval)
+
+            # Let running jobs finish (bounded by their own timeouts)
+            while self.running:
+                if time.monotonic() >= next_maintenance:
+                    self.queue.heartbeat(self.name)
+                    next_maintenance = time.monotonic() + self.maintenance_interval
+                self._collect(timeout=1.0)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._listen_conn.close()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.concurrency,
+            initializer=_init_child,
+            initargs=(self.modules,)
+        )
+
+    def _claim(self):
+        free = self.concurrency - len(self.running)
+        if free <= 0:
+            return 0
+
+        # Tasks already at their max_concurrent limit are left in the queue
+        counts = self.queue.running_counts()
+        saturated = [
+            name for name, spec in REGISTRY.items()
+            if spec["max_concurrent"] is not None
+            and counts.get(name, 0) >= spec["max_concurrent"]
+        ]
+
+        defaults = {
+            name: {"timeout": spec["timeout"], "max_attempts": spec["max_attempts"]}
+            for name, spec in REGISTRY.items()
+        }
+        jobs = self.queue.claim(self.name, free, saturated, defaults)
+        for job in jobs:
+            # A claim can overshoot a per-task limit when several due jobs
+            # share a task; put the extras back
+            limit = REGISTRY.get(job["task"], {}).get("max_concurrent")
+            if limit is not None and counts.get(job["task"], 0) >= limit:
+                self.queue.unclaim(job, self.name)
+                continue
+            counts[job["task"]] = counts.get(job["task"], 0) + 1
+
+            future = self._executor.submit(_execute, job["task"], job["payload"], job["timeout_seconds"])
+            self.running[future] = job
+        return len(jobs)
+
+    def _collect(self, timeout):
+        if not self.running:
+            return
+        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+        broken = False
+        for future in done:
+            job = self.running.pop(future)
+            try:
+                ok, outcome, duration_ms = future.result()
+            except BrokenProcessPool:
+                broken = True
+                ok, outcome, duration_ms = False, "Worker process died while running the job", 0
+            except Exception:
+                ok, outcome, duration_ms = False, traceback.format_exc(limit=5), 0
+
+            if ok:
+                self.queue.complete(job, self.name, duration_ms, outcome)
+                print(f"Job {job['id']} {job['task']}: succeeded in {duration_ms} ms")
+            else:
+                status = self.queue.fail(job, self.name, duration_ms, outcome)
+                print(f"Job {job['id']} {job['task']}: attempt {job['attempts']} failed, "
+                      f"now {status}: {outcome.strip().splitlines()[-1]}")
+
+        if broken:
+            self._executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.queue.config)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        cursor.execute(f"LISTEN {CHANNEL}")
+        cursor.close()
+        return conn
+
+    def _wait_for_notification(self, timeout):
+        if select.select([self._listen_conn], [], [], timeout) != ([], [], []):
+            self._drain_notifications()
+
+    def _drain_notifications(self):
+        self._listen_conn.poll()
+        self._listen_conn.notifies.clear()
+
+
+if __name__ == "__main__":
+    from db import get_config
+    # Use the importable module so tasks registered by job_tasks are visible here
+    from jobs import JobQueue, JobWorker, load_tasks
+
+    parser = argparse.ArgumentParser(description="Background job worker and queue tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = commands.add_parser("worker", help="run jobs until stopped")
+    worker_parser.add_argument("--concurrency", type=int, default=None,
+                               help="jobs run at once (default: CPU count)")
+    worker_parser.add_argument("--poll-interval", type=float, default=5.0)
+
+    enqueue_parser = commands.add_parser("enqueue", help="queue one job")
+    enqueue_parser.add_argument("task")
+    enqueue_parser.add_argument("--payload", type=json.loads, default={},
+                                help='JSON object of task arguments, e.g. \'{"apply": true}\'')
+    enqueue_parser.add_argument("--priority", type=int, default=0)
+
+    metrics_parser = commands.add_parser("metrics", help="print per-task timings")
+    metrics_parser.add_argument("--since", type=int, default=86400, help="seconds")
+
+    args = parser.parse_args()
+    queue = JobQueue(**get_config())
+
+    if args.command == "worker":
+        JobWorker(queue, args.concurrency, args.poll_interval).run()
+    elif args.command == "enqueue":
+        load_tasks()
+        print(f"Queued job {queue.enqueue(args.task, args.payload, priority=args.priority)}")
+    else:
+        metrics = queue.metrics(args.since)
+        for row in metrics["tasks"]:
+            print(f"{row['task']:<22} {row['attempts']:>6} runs  {row['failed']:>4} failed  "
+                  f"avg {row['avg_duration_ms']} ms  p95 {row['p95_duration_ms']:.0f} ms  "
+                  f"avg wait {row['avg_wait_ms']} ms")
+        for row in metrics["queue"]:
+            print(f"{row['task']:<22} queued {row['queued']}  due {row['due']}  running {row['running']}")
@@ -0,0 +1,74 @@
+"""Let Postgres build JSON so large result sets skip per-row Python decoding.
+
+The normal path fetches rows through RealDictCursor (one dict per row)
+and jsonify then walks every field. These helpers return the finished
+JSON document as bytes, ready to hand to a Flask Response.
+
+Output differs slightly from jsonify: numerics come back as JSON numbers
+rather than strings and timestamps as ISO 8601.
+"""
+
+
+def fetch_json_array(cursor, sql, params=()):
+    """Run a SELECT and return all of its rows as one JSON array (bytes).
+    Rows keep the ORDER BY of the inner query."""
+    cursor.execute(f"""
+        SELECT COALESCE(json_agg(t), '[]'::json)::text
+        FROM ({sql}) t
+    """, params)
+    return cursor.fetchone()[0].encode()
+
+
+def fetch_json_value(cursor, sql, params=()):
+    """Run a query whose single column is a json/jsonb value; return it as bytes"""
+    cursor.execute(f"SELECT ({sql})::text", params)
+    return cursor.fetchone()[0].encode()
+
+
+class JSONArrayStream:
+    """Iterable of byte chunks forming one JSON array, read from a server-side cursor.
+
+    The query runs on construction (so errors surface before a response
+    starts) and only batch_rows rows are in memory at a time. close() is
+    called by the WSGI server when the response ends or the client goes
+    away, and hands the connection to release(conn).
+    """
+
+    def __init__(self, conn, sql, params=(), release=None, batch_rows=2000):
+        self.conn = conn
+        self.release = release
+        self.batch_rows = batch_rows
+        self.cursor = conn.cursor(name="json_stream")
+        self.cursor.itersize = batch_rows
+
+        try:
+            self.cursor.execute(f"SELECT row_to_json(t)::text FROM ({sql}) t", params)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            yield b"["
+            first = True
+            while True:
+                rows = self.cursor.fetchmany(self.batch_rows)
+                if not rows:
+                    break
+                chunk = ",".join(row[0] for row in rows).encode()
+                yield chunk if first else b"," + chunk
+                first = False
+            yield b"]"
+        finally:
+            self.close()
+
+    def close(self):
+        if self.cursor is None:
+            return
+        try:
+            self.cursor.close()
+        except Exception:
+            pass  # already closed with its (failed) transaction
+        self.cursor = None
+        if self.release is not None:
+            self.release(self.conn)
@@ -0,0 +1,174 @@
+import re
+import threading
+import weakref
+from functools import lru_cache
+
+# Hot-path statements, prepared server-side once per connection on first use.
+# name -> (parameter types, statement body using $n placeholders)
+# quantity is the live total (see product_quantity() in the schema)
+PRODUCT_COLUMNS = """
+    id, product_code, name, category_id,
+    price, product_quantity(id, current_quantity) as quantity,
+    reorder_threshold, archived,
+    created_by, last_updated_by,
+    created_at, updated_at
+"""
+
+# Same columns for a product joined to its stock row at one location
+LOCATION_PRODUCT_COLUMNS = """
+    p.id, p.product_code, p.name, p.category_id,
+    p.price, COALESCE(ps.quantity, 0) as quantity,
+    p.reorder_threshold, p.archived,
+    p.created_by, p.last_updated_by,
+    p.created_at, p.updated_at
+"""
+
+STATEMENTS = {
+    "product_get_by_id": ("int", f"""
+        SELECT {PRODUCT_COLUMNS}
+        FROM products
+        WHERE id = $1
+        AND archived = FALSE
+    """),
+    "product_list": ("int", f"""
+        SELECT {PRODUCT_COLUMNS}
+        FROM products
+        WHERE archived = FALSE
+        ORDER BY id
+        LIMIT $1
+    """),
+    "product_search": ("text, int", f"""
+        SELECT {PRODUCT_COLUMNS}
+        FROM products
+        WHERE name ILIKE $1
+        AND archived = FALSE
+        ORDER BY id
+        LIMIT $2
+    """),
+    "product_list_at_location": ("int, int", f"""
+        SELECT {LOCATION_PRODUCT_COLUMNS}
+        FROM products p
+        LEFT JOIN product_stock ps ON ps.location_id = $1 AND ps.product_id = p.id
+        WHERE p.archived = FALSE
+        ORDER BY p.id
+        LIMIT $2
+    """),
+    "product_search_at_location": ("int, text, int", f"""
+        SELECT {LOCATION_PRODUCT_COLUMNS}
+        FROM products p
+        LEFT JOIN product_stock ps ON ps.location_id = $1 AND ps.product_id = p.id
+        WHERE p.name ILIKE $2
+        AND p.archived = FALSE
+        ORDER BY p.id
+        LIMIT $3
+    """),
+    # One fixed statement for every combination of fields; NULL keeps the old value.
+    # Returns the row before (old_*) and after the change for the audit log,
+    # with live stock totals on both sides; changed_at is read once the row
+    # lock is held, so it orders edits of a row.
+    "product_update": ("int, varchar, numeric, int, int, int", """
+        WITH before AS (
+            SELECT id, name, product_quantity(id, current_quantity) AS current_quantity,
+                   price, category_id, reorder_threshold
+            FROM products
+            WHERE id = $1
+            AND archived = FALSE
+            FOR UPDATE
+        )
+        UPDATE products p
+        SET name = COALESCE($2, p.name),
+            price = COALESCE($3, p.price),
+            category_id = COALESCE($4, p.category_id),
+            reorder_threshold = COALESCE($5, p.reorder_threshold),
+            last_updated_by = $6,
+            updated_at = CURRENT_TIMESTAMP
+        FROM before b
+        WHERE p.id = b.id
+        RETURNING b.name AS old_name, b.current_quantity AS old_current_quantity,
+                  b.price AS old_price, b.category_id AS old_category_id,
+                  b.reorder_threshold AS old_reorder_threshold,
+                  p.name, product_quantity(p.id, p.current_quantity) AS current_quantity,
+                  p.price, p.category_id,
+                  p.reorder_threshold,
+                  clock_timestamp()::timestamp AS changed_at
+    """),
+    # A NULL location ($1) takes the stock from the MAIN location
+    "stock_decrement": ("int, int, int", """
+        UPDATE product_stock ps
+        SET quantity = ps.quantity - $3,
+            updated_at = CURRENT_TIMESTAMP
+        FROM products p
+        WHERE ps.location_id = COALESCE($1, (SELECT id FROM locations WHERE code = 'MAIN'))
+        AND ps.product_id = $2
+        AND p.id = ps.product_id
+        AND p.archived = FALSE
+        AND ps.quantity >= $3
+        RETURNING ps.quantity
+    """),
+    # Like stock_decrement, a NULL location ($7) records the sale against MAIN
+    "sale_transaction_insert": ("timestamp, int, numeric, numeric, numeric, numeric, int", """
+        INSERT INTO sale_transaction
+        (date, cashier_id, subtotal, tax, discount, total, location_id)
+        VALUES ($1, $2, $3, $4, $5, $6,
+                COALESCE($7, (SELECT id FROM locations WHERE code = 'MAIN')))
+        RETURNING transaction_id
+    """),
+    "sale_item_insert": ("int, int, int, numeric", """
+        INSERT INTO sale_item
+        (transaction_id, product_id, quantity, price_at_sale)
+        VALUES ($1, $2, $3, $4)
+        RETURNING sale_item_id
+    """),
+}
+
+_lock = threading.Lock()
+_prepared = weakref.WeakKeyDictionary()  # connection -> set of prepared names
+
+
+def prepared_on(conn):
+    """Names of registry statements already prepared on this connection"""
+    with _lock:
+        return _prepared.setdefault(conn, set())
+
+
+def execute_prepared(cursor, name, params=()):
+    """Run a registry statement with EXECUTE, preparing it on first use.
+
+    PREPARE is session-level and survives rollbacks, so on a pooled
+    connection each statement is parsed and planned once for its lifetime.
+    """
+    done = prepared_on(cursor.connection)
+
+    if name not in done:
+        types, body = STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({types}) AS {body}")
+        done.add(name)
+
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})" if params else f"EXECUTE {name}", params)
+
+
+@lru_cache(maxsize=None)
+def plain_sql(name):
+    """Registry statement rewritten for a normal execute() ($n -> %(pn)s)"""
+    return re.sub(r"\$(\d+)", r"%(p\1)s", STATEMENTS[name][1])
+
+
+def plain_params(params):
+    """Positional parameters as the %(pn)s mapping plain_sql() expects"""
+    return {f"p{i}": value for i, value in enumerate(params, 1)}
+
+
+def execute_statement(cursor, name, params=(), prepare=True):
+    """Run a registry statement, prepared or as plain text.
+    Preparing only pays off on connections that are reused (i.e. pooled)."""
+    if prepare:
+        execute_prepared(cursor, name, params)
+    else:
+        cursor.execute(plain_sql(name), plain_params(params))
+
+
+def forget(conn):
+    """Drop tracking for a connection whose session was reset (e.g. DISCARD ALL)"""
+    with _lock:
+        _prepared.pop(conn, None)
@@ -0,0 +1,154 @@
+"""Change history for products.
+
+InventoryCRUD hands every committed add/update/delete to ProductAuditLog.record(),
+which only queues it; a background thread writes queued records to
+product_audit in batches over its own connection, so requests never wait on
+the audit insert. Each row stores just the fields that changed, as
+{"field": [before, after]}.
+"""
+import atexit
+import json
+import queue
+import threading
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+from db import DatabaseClient
+
+# Product fields whose before/after values are kept
+AUDITED_FIELDS = (
+    "product_code", "name", "category_id", "price",
+    "current_quantity", "reorder_threshold", "archived"
+)
+
+ACTIONS = ("create", "update", "archive", "delete")
+
+
+def diff(before, after):
+    """{field: [old, new]} for audited fields whose value differs"""
+    changes = {}
+    for field in AUDITED_FIELDS:
+        old, new = before.get(field), after.get(field)
+        if old != new:
+            changes[field] = [old, new]
+    return changes
+
+
+class ProductAuditLog(DatabaseClient):
+    def __init__(self, host, database, user, password, pool=None,
+                 batch_size=500, max_pending=10000, retries=3):
+        super().__init__(host, database, user, password, pool)
+        self.batch_size = batch_size
+        self.retries = retries
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    # ---------------------- RECORDING ----------------------
+    def record(self, product_id, action, changes, changed_by=None, changed_at=None):
+        """Queue one history row; returns immediately. Empty changes are ignored."""
+        if action not in ACTIONS:
+            raise ValueError(f"Audit action must be one of: {', '.join(ACTIONS)}")
+        if not changes:
+            return
+
+        row = (product_id, action, changed_by, changed_at,
+               json.dumps(changes, default=str))
+        self._start_writer()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # The writer is far behind (database down?); wait for room rather than lose it
+            self._queue.put(row)
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far is written. False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="product-audit-writer", daemon=True
+                )
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write_loop(self):
+        conn = None
+        while True:
+            batch = [self._queue.get()]
+            # Take whatever else is already waiting: batches grow with load
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for attempt in range(1, self.retries + 1):
+                try:
+                    if conn is None or conn.closed:
+                        conn = psycopg2.connect(**self.config)
+                    self._insert(conn, batch)
+                    break
+                except Exception as e:
+                    if conn is not None and not conn.closed:
+                        conn.rollback()
+                    conn = None
+                    if attempt == self.retries:
+                        print(f"DEBUG: ERROR writing {len(batch)} product audit records: {str(e)}")
+                    else:
+                        time.sleep(0.5 * attempt)
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def _insert(self, conn, batch):
+        cursor = conn.cursor()
+        try:
+            execute_values(cursor, """
+                INSERT INTO product_audit
+                (product_id, action, changed_by, changed_at, changes)
+                VALUES %s
+            """, batch,
+                template="(%s, %s, %s, COALESCE(%s::timestamp, LOCALTIMESTAMP), %s::jsonb)",
+                page_size=len(batch))
+            conn.commit()
+        finally:
+            cursor.close()
+
+    # ---------------------- QUERIES ----------------------
+    def history(self, product_id, start=None, end=None, limit=200):
+        """Changes to one product, newest first, optionally within [start, end)"""
+        if not product_id:
+            raise ValueError("Product ID is required.")
+
+        conn = self.connect()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+        try:
+            cursor.execute("""
+                SELECT id, product_id, action, changed_by, changed_at, changes
+                FROM product_audit
+                WHERE product_id = %s
+                AND changed_at >= COALESCE(%s::timestamp, '-infinity')
+                AND changed_at < COALESCE(%s::timestamp, 'infinity')
+                ORDER BY changed_at DESC, id DESC
+                LIMIT %s
+            """, (product_id, start, end, limit))
+            return cursor.fetchall()
+
+        finally:
+            cursor.close()
+            self.release(conn)
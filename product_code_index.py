@@ -0,0 +1,134 @@
+import json
+import select
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+import psycopg2.extensions
+
+from db import DatabaseClient
+
+
+class ProductCodeIndex(DatabaseClient):
+    """In-process product_code -> (product id, price) map for till scans.
+
+    Warmed from the products table, then kept current by the
+    notify_product_change() trigger on the product_changes channel.
+    """
+
+    CHANNEL = "product_changes"
+
+    def __init__(self, host, database, user, password, poll_timeout=5.0):
+        super().__init__(host, database, user, password)
+        self.poll_timeout = poll_timeout
+        self.warmed_at = None
+        self._entries = {}
+        self._stop = threading.Event()
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    # ---------------------- LOOKUPS ----------------------
+    def lookup(self, product_code):
+        """Return (product_id, price) for a code, or None if not indexed"""
+        return self._entries.get(product_code)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def is_warm(self):
+        return self.warmed_at is not None
+
+    # ---------------------- LOADING ----------------------
+    def warm(self):
+        """Rebuild the whole map from the database"""
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("""
+                SELECT product_code, id, price
+                FROM products
+                WHERE archived = FALSE
+                AND product_code IS NOT NULL
+            """)
+            # Swap in a fresh dict so readers never see a half-built map
+            self._entries = {code: (product_id, price) for code, product_id, price in cursor}
+            self.warmed_at = datetime.now()
+            return len(self._entries)
+
+        finally:
+            cursor.close()
+            conn.close()
+
+    def apply_change(self, payload):
+        """Apply one product_changes notification payload to the map"""
+        change = json.loads(payload, parse_float=Decimal)
+        product_id = change["id"]
+
+        old_code = change.get("old_code")
+        if old_code is not None and self._entries.get(old_code, (None,))[0] == product_id:
+            del self._entries[old_code]
+
+        code = change.get("product_code")
+        if code is None:
+            return
+
+        if change["op"] == "DELETE" or change.get("archived"):
+            if self._entries.get(code, (None,))[0] == product_id:
+                del self._entries[code]
+        else:
+            self._entries[code] = (product_id, Decimal(str(change["price"])))
+
+    # ---------------------- CHANGE LISTENER ----------------------
+    def start(self, wait=True):
+        """LISTEN for product changes in a daemon thread, then warm the map.
+        With wait=False return immediately; lookups miss until warm."""
+        if self._listener and self._listener.is_alive():
+            return
+
+        ready = threading.Event()
+        with self._start_lock:
+            # Concurrent first lookups must not start two listeners
+            if self._listener and self._listener.is_alive():
+                return
+            self._stop.clear()
+            self._listener = threading.Thread(
+                target=self._listen, args=(ready,),
+                name="product-code-index", daemon=True
+            )
+            self._listener.start()
+        if wait:
+            ready.wait(self.poll_timeout)
+
+    def stop(self):
+        self._stop.set()
+        if self._listener:
+            self._listener.join(self.poll_timeout + 1)
+
+    def _listen(self, ready):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {self.CHANNEL};")
+
+                # Warm only after LISTEN so changes made in between are not lost
+                self.warm()
+                ready.set()
+
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.apply_change(conn.notifies.pop(0).payload)
+
+            except Exception as e:
+                print(f"DEBUG: product code index listener error: {str(e)}")
+                ready.set()
+                self._stop.wait(self.poll_timeout)
+            finally:
+                if conn is not None:
+                    conn.close()
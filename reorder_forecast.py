@@ -0,0 +1,336 @@
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+from db import DatabaseClient, get_config
+
+# Binary COPY framing: 11-byte signature + int32 flags + int32 header extension length
+COPY_HEADER_SIZE = 19
+COPY_TRAILER = b"\xff\xff"
+
+# One COPY row of (product_id int4, quantity int4):
+# int16 field count, then int32 length + int32 value for each field
+DEMAND_ROW = np.dtype([
+    ("fields", ">i2"),
+    ("id_len", ">i4"), ("product_id", ">i4"),
+    ("qty_len", ">i4"), ("quantity", ">i4"),
+])
+
+
+class _DemandAccumulator:
+    """File-like sink for COPY ... TO STDOUT (FORMAT binary).
+
+    Decodes rows in whole chunks with numpy and folds them into per-product
+    sum / sum-of-squares / days-with-sales arrays, so the window never has to
+    fit in memory.
+    """
+
+    def __init__(self, product_ids, chunk_bytes=8 * 1024 * 1024):
+        self.product_ids = product_ids
+        self.sums = np.zeros(len(product_ids), dtype=np.float64)
+        self.sums_sq = np.zeros(len(product_ids), dtype=np.float64)
+        self.sale_days = np.zeros(len(product_ids), dtype=np.int64)
+        self.rows = 0
+        self.chunk_bytes = chunk_bytes
+        self._chunks = []
+        self._buffered = 0
+        self._header_done = False
+
+    def write(self, data):
+        # psycopg2 calls write() once per COPY row, so batch before decoding
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_bytes:
+            self._drain()
+
+    def finish(self):
+        self._drain()
+        if self._chunks and self._chunks[0] != COPY_TRAILER:
+            raise ValueError("Unexpected trailing data in demand COPY stream.")
+
+    def _drain(self):
+        buf = b"".join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+
+        if not self._header_done:
+            if len(buf) < COPY_HEADER_SIZE:
+                self._keep(buf)
+                return
+            buf = buf[COPY_HEADER_SIZE:]
+            self._header_done = True
+
+        usable = len(buf) - len(buf) % DEMAND_ROW.itemsize
+        self._keep(buf[usable:])
+        if usable:
+            self._fold(np.frombuffer(buf, dtype=DEMAND_ROW, count=usable // DEMAND_ROW.itemsize))
+
+    def _keep(self, remainder):
+        if remainder:
+            self._chunks.append(remainder)
+            self._buffered = len(remainder)
+
+    def _fold(self, records):
+        idx = np.searchsorted(self.product_ids, records["product_id"])
+        # Sales for products that have since been archived fall outside the id list
+        valid = (idx < len(self.product_ids))
+        valid[valid] = self.product_ids[idx[valid]] == records["product_id"][valid]
+        idx = idx[valid]
+        qty = records["quantity"][valid].astype(np.float64)
+
+        n = len(self.product_ids)
+        self.sums += np.bincount(idx, weights=qty, minlength=n)
+        self.sums_sq += np.bincount(idx, weights=qty * qty, minlength=n)
+        self.sale_days += np.bincount(idx[qty > 0], minlength=n)
+        self.rows += len(records)
+
+
+class ReorderForecast(DatabaseClient):
+    """Batch job computing suggested reorder thresholds from sales history"""
+
+    def __init__(self, host, database, user, password,
+                 window_days=90, lead_time_days=7, review_days=14,
+                 service_z=1.65, min_history_days=28, min_sale_days=3):
+        super().__init__(host, database, user, password)
+        self.window_days = window_days
+        self.lead_time_days = lead_time_days
+        self.review_days = review_days
+        self.service_z = service_z
+        # Products with less history than this keep their current threshold
+        self.min_history_days = min_history_days
+        self.min_sale_days = min_sale_days
+
+    # ---------------------------------------------------------
+    # 1) INCREMENTAL DAILY DEMAND ROLLUP
+    # ---------------------------------------------------------
+    def refresh_daily_demand(self, cursor, window_start, through_day):
+        """
+        Rolls sale_item rows up into product_daily_demand so that every day
+        from window_start up to and including through_day is aggregated.
+        Earlier runs already covered MIN(sales_from)..MAX(sales_through);
+        only the days after that and, for a longer window than before, the
+        days before it are read. Returns the first day that was (re)aggregated.
+        """
+        cursor.execute("SELECT MIN(sales_from), MAX(sales_through) FROM forecast_runs")
+        covered_from, covered_through = cursor.fetchone()
+
+        ranges = []
+        if covered_from is None:
+            # First run, or only runs from before sales_from was recorded
+            ranges.append((window_start, max(through_day, covered_through or through_day)))
+        else:
+            if window_start < covered_from:
+                ranges.append((window_start, covered_from - timedelta(days=1)))
+            if covered_through < through_day:
+                ranges.append((covered_through + timedelta(days=1), through_day))
+
+        for first_day, last_day in ranges:
+            self._roll_up(cursor, first_day, last_day)
+
+        return ranges[0][0] if ranges else covered_through + timedelta(days=1)
+
+    def _roll_up(self, cursor, first_day, last_day):
+        cursor.execute("""
+            INSERT INTO product_daily_demand (product_id, sales_day, quantity)
+            SELECT si.product_id, st.date::date, SUM(si.quantity)
+            FROM sale_item si
+            JOIN sale_transaction st ON st.transaction_id = si.transaction_id
+            WHERE st.date >= %s AND st.date < %s
+            GROUP BY si.product_id, st.date::date
+            ON CONFLICT (product_id, sales_day)
+            DO UPDATE SET quantity = EXCLUDED.quantity
+        """, (first_day, last_day + timedelta(days=1)))
+
+    # ---------------------------------------------------------
+    # 2) VECTORIZED DEMAND STATISTICS
+    # ---------------------------------------------------------
+    def load_demand_sums(self, cursor, product_ids, window_start, window_end):
+        """
+        Streams the demand window out of Postgres in binary COPY format
+        and returns per-product (sum, sum of squares, days with sales) arrays.
+        """
+        accumulator = _DemandAccumulator(product_ids)
+        query = cursor.mogrify("""
+            COPY (
+                SELECT product_id::int4, quantity::int4
+                FROM product_daily_demand
+                WHERE sales_day BETWEEN %s AND %s
+            ) TO STDOUT WITH (FORMAT binary)
+        """, (window_start, window_end)).decode()
+
+        cursor.copy_expert(query, accumulator)
+        accumulator.finish()
+        return accumulator.sums, accumulator.sums_sq, accumulator.sale_days
+
+    def observed_days(self, created_days, window_end):
+        """Days of the window each product existed for (its created day onwards)"""
+        age = np.array([(window_end - day).days + 1 for day in created_days], dtype=np.int64)
+        return np.clip(age, 0, self.window_days)
+
+    def compute_suggestions(self, sums, sums_sq, days):
+        """
+        Computes mean / standard deviation of daily demand for all products
+        at once over each product's own observed days, including zero-sale
+        days, and derives:
+        - reorder threshold = lead-time demand + safety stock
+        - reorder quantity  = expected demand over one review period
+        """
+        n = np.maximum(days, 1).astype(np.float64)
+        mean = sums / n
+        variance = np.maximum(sums_sq / n - mean * mean, 0.0)
+        variance *= np.where(n > 1, n / np.maximum(n - 1, 1), 1.0)
+        std = np.sqrt(variance)
+
+        safety_stock = self.service_z * std * np.sqrt(self.lead_time_days)
+        reorder_threshold = np.ceil(mean * self.lead_time_days + safety_stock)
+        reorder_quantity = np.ceil(mean * self.review_days)
+
+        return {
+            "avg_daily_demand": mean,
+            "demand_stddev": std,
+            "reorder_threshold": reorder_threshold.astype(np.int64),
+            "reorder_quantity": reorder_quantity.astype(np.int64),
+        }
+
+    # ---------------------------------------------------------
+    # 3) PERSIST SUGGESTIONS
+    # ---------------------------------------------------------
+    def save_suggestions(self, cursor, product_ids, stats, window_start, window_end):
+        rows = zip(
+            product_ids.tolist(),
+            np.round(stats["avg_daily_demand"], 4).tolist(),
+            np.round(stats["demand_stddev"], 4).tolist(),
+            stats["reorder_threshold"].tolist(),
+            stats["reorder_quantity"].tolist(),
+            [window_start] * len(product_ids),
+            [window_end] * len(product_ids),
+        )
+
+        execute_values(cursor, """
+            INSERT INTO reorder_suggestions
+            (product_id, avg_daily_demand, demand_stddev,
+             suggested_reorder_threshold, suggested_reorder_quantity,
+             window_start, window_end, computed_at)
+            VALUES %s
+            ON CONFLICT (product_id) DO UPDATE SET
+                avg_daily_demand = EXCLUDED.avg_daily_demand,
+                demand_stddev = EXCLUDED.demand_stddev,
+                suggested_reorder_threshold = EXCLUDED.suggested_reorder_threshold,
+                suggested_reorder_quantity = EXCLUDED.suggested_reorder_quantity,
+                window_start = EXCLUDED.window_start,
+                window_end = EXCLUDED.window_end,
+                computed_at = EXCLUDED.computed_at
+        """, rows,
+            template="(%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)",
+            page_size=10000)
+
+    def discard_suggestions(self, cursor, product_ids):
+        """Drop earlier suggestions for products without enough history this run"""
+        cursor.execute(
+            "DELETE FROM reorder_suggestions WHERE product_id = ANY(%s)",
+            (product_ids.tolist(),)
+        )
+
+    def apply_suggestions(self, cursor):
+        """Copy suggested thresholds onto products.reorder_threshold"""
+        cursor.execute("""
+            UPDATE products p
+            SET reorder_threshold = rs.suggested_reorder_threshold,
+                updated_at = CURRENT_TIMESTAMP
+            FROM reorder_suggestions rs
+            WHERE rs.product_id = p.id
+              AND p.archived = FALSE
+              AND p.reorder_threshold IS DISTINCT FROM rs.suggested_reorder_threshold
+        """)
+        return cursor.rowcount
+
+    # ---------------------------------------------------------
+    # 4) FULL RUN
+    # ---------------------------------------------------------
+    def run(self, as_of=None, apply=False):
+        """
+        Runs the job for the window ending the day before as_of (default today).
+        Only days not covered by earlier runs are re-read from sale_item.
+        """
+        started = time.perf_counter()
+        as_of = as_of or date.today()
+        window_end = as_of - timedelta(days=1)
+        window_start = window_end - timedelta(days=self.window_days - 1)
+
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            rolled_from = self.refresh_daily_demand(cursor, window_start, window_end)
+
+            cursor.execute("""
+                SELECT id, created_at::date FROM products
+                WHERE archived = FALSE ORDER BY id
+            """)
+            rows = cursor.fetchall()
+            product_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            days = self.observed_days([row[1] for row in rows], window_end)
+
+            sums, sums_sq, sale_days = self.load_demand_sums(
+                cursor, product_ids, window_start, window_end
+            )
+
+            # New and out-of-season products would otherwise get a threshold of 0
+            eligible = (days >= self.min_history_days) & (sale_days >= self.min_sale_days)
+            stats = self.compute_suggestions(sums[eligible], sums_sq[eligible], days[eligible])
+            self.save_suggestions(cursor, product_ids[eligible], stats, window_start, window_end)
+            self.discard_suggestions(cursor, product_ids[~eligible])
+
+            applied = self.apply_suggestions(cursor) if apply else 0
+
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            cursor.execute("""
+                INSERT INTO forecast_runs
+                (sales_from, sales_through, products_processed, duration_ms)
+                VALUES (%s, %s, %s, %s)
+            """, (window_start, window_end, len(product_ids), duration_ms))
+
+            conn.commit()
+
+            return {
+                "job": "reorder_forecast",
+                "generated_at": datetime.now(),
+                "window_start": window_start,
+                "window_end": window_end,
+                "rolled_up_from": rolled_from,
+                "products_processed": len(product_ids),
+                "products_skipped": int((~eligible).sum()),
+                "thresholds_applied": applied,
+                "duration_ms": duration_ms
+            }
+
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.release(conn)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute suggested reorder thresholds")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=None,
+                        help="Run as if on this date (YYYY-MM-DD)")
+    parser.add_argument("--window-days", type=int, default=90)
+    parser.add_argument("--lead-time-days", type=int, default=7)
+    parser.add_argument("--review-days", type=int, default=14)
+    parser.add_argument("--apply", action="store_true",
+                        help="Also overwrite products.reorder_threshold")
+    args = parser.parse_args()
+
+    forecast = ReorderForecast(
+        **get_config(),
+        window_days=args.window_days,
+        lead_time_days=args.lead_time_days,
+        review_days=args.review_days
+    )
+    print(forecast.run(as_of=args.as_of, apply=args.apply))
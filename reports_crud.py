@@ -1,62 +1,143 @@
-import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime, date
+from db import DatabaseClient
+from json_rows import fetch_json_value
+from inventory_valuation import InventoryValuation
 
+# Row queries shared by the dict reports and their *_json counterparts
+SALES_REPORT_SQL = """
+    SELECT 
+        si.product_id,
+        p.name,
+        p.category_id,
+        SUM(si.quantity) AS total_quantity_sold,
+        -- price_at_sale is already the line total (unit price * quantity)
+        SUM(si.price_at_sale) AS total_sales
+    FROM sale_item si
+    JOIN sale_transaction st ON st.transaction_id = si.transaction_id
+    JOIN products p ON si.product_id = p.id
+    -- Both dates are inclusive: the end date covers its whole day
+    WHERE st.date >= %s::date AND st.date < %s::date + 1
+"""
 
-class ReportsCRUD:
-    def __init__(self, host, database, user, password):
-        self.config = {
-            "host": host,
-            "database": database,
-            "user": user,
-            "password": password
-        }
+# Totals include stock changes not yet folded into products.current_quantity
+LOW_STOCK_SQL = """
+    SELECT 
+        id, product_code, name, current_quantity, 
+        reorder_threshold, price
+    FROM (
+        SELECT id, product_code, name,
+               product_quantity(id, current_quantity) AS current_quantity,
+               reorder_threshold, price
+        FROM products
+        WHERE archived = FALSE
+    ) p
+    WHERE current_quantity <= reorder_threshold
+    ORDER BY current_quantity ASC
+"""
 
-    def connect(self):
-        return psycopg2.connect(**self.config)
+INVENTORY_SNAPSHOT_SQL = """
+    SELECT 
+        p.id, p.product_code, p.name,
+        p.current_quantity, p.price,
+        p.reorder_threshold, c.name AS category,
+        (p.price * p.current_quantity) AS stock_value
+    FROM (
+        SELECT id, product_code, name, category_id, price, reorder_threshold,
+               product_quantity(id, current_quantity) AS current_quantity
+        FROM products
+        WHERE archived = FALSE
+    ) p
+    LEFT JOIN categories c ON c.id = p.category_id
+    ORDER BY c.name, p.name
+"""
+
+# Location-scoped variants: quantities are the stock held at one location
+LOCATION_LOW_STOCK_SQL = """
+    SELECT 
+        p.id, p.product_code, p.name, ps.quantity AS current_quantity, 
+        p.reorder_threshold, p.price, ps.location_id
+    FROM product_stock ps
+    JOIN products p ON p.id = ps.product_id
+    WHERE ps.location_id = %s
+      AND p.archived = FALSE
+      AND ps.quantity <= p.reorder_threshold
+    ORDER BY ps.quantity ASC
+"""
+
+LOCATION_INVENTORY_SNAPSHOT_SQL = """
+    SELECT 
+        p.id, p.product_code, p.name,
+        ps.quantity AS current_quantity, p.price,
+        p.reorder_threshold, c.name AS category,
+        (p.price * ps.quantity) AS stock_value,
+        ps.location_id
+    FROM product_stock ps
+    JOIN products p ON p.id = ps.product_id
+    LEFT JOIN categories c ON c.id = p.category_id
+    WHERE ps.location_id = %s
+      AND p.archived = FALSE
+    ORDER BY c.name, p.name
+"""
+
+
+class ReportsCRUD(DatabaseClient):
+    def __init__(self, host, database, user, password, pool=None):
+        super().__init__(host, database, user, password, pool)
+        self.valuation = InventoryValuation(host, database, user, password, pool=pool)
 
     # ---------------------------------------------------------
     # 1) MONTHLY INVENTORY REPORT
     # ---------------------------------------------------------
-    def monthly_inventory_report(self, year=None, month=None):
+    def monthly_inventory_report(self, year=None, month=None, method="weighted_average"):
         """
-        Generates a monthly inventory report summarizing:
-        - Current stock
-        - Low-stock items
-        - Total stock value
+        Generates a monthly inventory report as at the end of the month:
+        - Stock on hand at month-end
+        - Low-stock items (against current thresholds)
+        - Total stock value at cost (weighted average or FIFO)
+        Ended months come from their stored snapshot; the current
+        month is valued as of now.
         """
         if year is None or month is None:
             today = date.today()
             year, month = today.year, today.month
 
+        valuation = self.valuation.month_valuation(year, month, method)
+        positions = {row["product_id"]: row for row in valuation["products"]}
+
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
-            # Fetch all inventory with low-stock flag
             cursor.execute("""
                 SELECT 
-                    p.id, p.product_code, p.name, p.current_quantity,
-                    p.price, p.reorder_threshold,
-                    (p.price * p.current_quantity) AS stock_value,
-                    (p.current_quantity <= p.reorder_threshold) AS is_low_stock
+                    p.id, p.product_code, p.name,
+                    p.price, p.reorder_threshold
                 FROM products p
-                WHERE p.archived = FALSE
+                WHERE p.id = ANY(%s)
                 ORDER BY p.name;
-            """)
+            """, (list(positions),))
 
-            products = cursor.fetchall()
+            products = []
+            for item in cursor.fetchall():
+                position = positions[item["id"]]
+                item["current_quantity"] = position["quantity"]
+                item["unit_cost"] = position["unit_cost"]
+                item["stock_value"] = position["stock_value"]
+                item["is_low_stock"] = position["quantity"] <= item["reorder_threshold"]
+                products.append(item)
 
-            # Totals
-            total_stock_value = sum(item["stock_value"] for item in products)
             low_stock_items = [item for item in products if item["is_low_stock"]]
 
             return {
                 "report_type": "monthly_inventory_report",
                 "year": year,
                 "month": month,
+                "period_end": valuation["period_end"],
+                "valuation_method": method,
+                "source": valuation["source"],
                 "generated_at": datetime.now(),
-                "total_stock_value": total_stock_value,
+                "total_stock_value": valuation["total_value"],
                 "total_products": len(products),
                 "low_stock_count": len(low_stock_items),
                 "low_stock_items": low_stock_items,
@@ -65,43 +146,21 @@ class ReportsCRUD:
 
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
 
     # ---------------------------------------------------------
     # 2) SALES REPORT (DATE RANGE)
     # ---------------------------------------------------------
-    def sales_report(self, start_date, end_date, category_id=None):
+    def sales_report(self, start_date, end_date, category_id=None, location_id=None):
         """
         Generates a sales report for a date range.
-        Optionally filters by product category.
+        Optionally filters by product category and by the location sold from.
         """
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
-            sql = """
-                SELECT 
-                    si.product_id,
-                    p.name,
-                    p.category_id,
-                    SUM(si.quantity) AS total_quantity_sold,
-                    SUM(si.price * si.quantity) AS total_sales
-                FROM sale_items si
-                JOIN sales s ON si.sale_id = s.id
-                JOIN products p ON si.product_id = p.id
-                WHERE s.created_at BETWEEN %s AND %s
-            """
-
-            params = [start_date, end_date]
-
-            if category_id:
-                sql += " AND p.category_id = %s"
-                params.append(category_id)
-
-            sql += """
-                GROUP BY si.product_id, p.name, p.category_id
-                ORDER BY total_sales DESC;
-            """
+            sql, params = self._sales_report_query(start_date, end_date, category_id, location_id)
 
             cursor.execute(sql, params)
             results = cursor.fetchall()
@@ -110,6 +169,7 @@ class ReportsCRUD:
                 "report_type": "sales_report",
                 "start_date": start_date,
                 "end_date": end_date,
+                "location_id": location_id,
                 "generated_at": datetime.now(),
                 "items": results,
                 "total_revenue": sum(item["total_sales"] for item in results)
@@ -117,33 +177,48 @@ class ReportsCRUD:
 
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
+
+    def _sales_report_query(self, start_date, end_date, category_id=None, location_id=None):
+        sql = SALES_REPORT_SQL
+        params = [start_date, end_date]
+
+        if category_id:
+            sql += " AND p.category_id = %s"
+            params.append(category_id)
+
+        if location_id is not None:
+            sql += " AND st.location_id = %s"
+            params.append(location_id)
+
+        sql += """
+            GROUP BY si.product_id, p.name, p.category_id
+            ORDER BY total_sales DESC
+        """
+        return sql, params
 
     # ---------------------------------------------------------
     # 3) LOW-STOCK REPORT
     # ---------------------------------------------------------
-    def low_stock_report(self):
+    def low_stock_report(self, location_id=None):
         """
         Generates a list of all products at or below threshold.
+        With location_id, compares that location's stock to the threshold.
         """
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
-            cursor.execute("""
-                SELECT 
-                    id, product_code, name, current_quantity, 
-                    reorder_threshold, price
-                FROM products
-                WHERE archived = FALSE
-                  AND current_quantity <= reorder_threshold
-                ORDER BY current_quantity ASC;
-            """)
+            if location_id is None:
+                cursor.execute(LOW_STOCK_SQL)
+            else:
+                cursor.execute(LOCATION_LOW_STOCK_SQL, (location_id,))
 
             items = cursor.fetchall()
 
             return {
                 "report_type": "low_stock_report",
+                "location_id": location_id,
                 "generated_at": datetime.now(),
                 "count": len(items),
                 "items": items
@@ -151,35 +226,30 @@ class ReportsCRUD:
 
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
 
     # ---------------------------------------------------------
     # 4) FULL INVENTORY SNAPSHOT (ON-DEMAND)
     # ---------------------------------------------------------
-    def inventory_snapshot(self):
+    def inventory_snapshot(self, location_id=None):
         """
-        Returns real-time inventory with categories and values.
+        Returns real-time inventory with categories and values,
+        for all locations combined or for one location.
         """
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
-            cursor.execute("""
-                SELECT 
-                    p.id, p.product_code, p.name,
-                    p.current_quantity, p.price,
-                    p.reorder_threshold, c.name AS category,
-                    (p.price * p.current_quantity) AS stock_value
-                FROM products p
-                LEFT JOIN categories c ON c.id = p.category_id
-                WHERE p.archived = FALSE
-                ORDER BY c.name, p.name;
-            """)
+            if location_id is None:
+                cursor.execute(INVENTORY_SNAPSHOT_SQL)
+            else:
+                cursor.execute(LOCATION_INVENTORY_SNAPSHOT_SQL, (location_id,))
 
             records = cursor.fetchall()
 
             return {
                 "report_type": "inventory_snapshot",
+                "location_id": location_id,
                 "generated_at": datetime.now(),
                 "total_products": len(records),
                 "products": records,
@@ -188,4 +258,70 @@ class ReportsCRUD:
 
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
+
+    # ---------------------------------------------------------
+    # 5) PRE-SERIALIZED JSON VARIANTS
+    # ---------------------------------------------------------
+    # Same reports, but the whole document is built by Postgres and returned
+    # as JSON bytes, so no per-row dicts are created in Python.
+
+    def _report_json(self, sql, params=()):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        try:
+            return fetch_json_value(cursor, sql, params)
+        finally:
+            cursor.close()
+            self.release(conn)
+
+    def sales_report_json(self, start_date, end_date, category_id=None, location_id=None):
+        rows_sql, params = self._sales_report_query(start_date, end_date, category_id, location_id)
+        return self._report_json(f"""
+            SELECT json_build_object(
+                'report_type', 'sales_report',
+                'start_date', %s::text,
+                'end_date', %s::text,
+                'location_id', %s::int,
+                'generated_at', LOCALTIMESTAMP,
+                'items', COALESCE(json_agg(r), '[]'::json),
+                'total_revenue', COALESCE(SUM(r.total_sales), 0)
+            )
+            FROM ({rows_sql}) r
+        """, [str(start_date), str(end_date), location_id] + params)
+
+    def low_stock_report_json(self, location_id=None):
+        if location_id is None:
+            rows_sql, params = LOW_STOCK_SQL, []
+        else:
+            rows_sql, params = LOCATION_LOW_STOCK_SQL, [location_id]
+
+        return self._report_json(f"""
+            SELECT json_build_object(
+                'report_type', 'low_stock_report',
+                'location_id', %s::int,
+                'generated_at', LOCALTIMESTAMP,
+                'count', COUNT(*),
+                'items', COALESCE(json_agg(r), '[]'::json)
+            )
+            FROM ({rows_sql}) r
+        """, [location_id] + params)
+
+    def inventory_snapshot_json(self, location_id=None):
+        if location_id is None:
+            rows_sql, params = INVENTORY_SNAPSHOT_SQL, []
+        else:
+            rows_sql, params = LOCATION_INVENTORY_SNAPSHOT_SQL, [location_id]
+
+        return self._report_json(f"""
+            SELECT json_build_object(
+                'report_type', 'inventory_snapshot',
+                'location_id', %s::int,
+                'generated_at', LOCALTIMESTAMP,
+                'total_products', COUNT(*),
+                'products', COALESCE(json_agg(r), '[]'::json),
+                'total_stock_value', COALESCE(SUM(r.stock_value), 0)
+            )
+            FROM ({rows_sql}) r
+        """, [location_id] + params)
@@ -46,26 +46,15 @@ class sale_transaction:
             "total": total
         }
     
-    def finalize_transaction(self, cashier_id):
-        """Finalize the transaction and save to database"""
+    def finalize_transaction(self, cashier_id, location_id=None):
+        """Finalize the transaction and save to database.
+        location_id takes the stock from (and records the sale at) that store."""
         transaction_data = self.calculate_transaction_data()
 
-        #update inventory
-        for item in self.sale_items:
-            product = self.product_db.search_product_sales(item.product["name"])
-            #convert realdict to normal dict
-            product = dict(product)
-            quantity_available = product["current_quantity"]
-            updated_quantity = quantity_available - item.quantity
-            
-            self.inventory_db.update_product(
-                product_id=item.product["id"],
-                quantity=updated_quantity
-            )
-
-        # Here we would insert the transaction and its items into the database
+        # Stock decrement (relative, so concurrent tills can't overwrite each other)
+        # and the sale rows commit together: a failure leaves neither behind
         date = 'NOW()'  # In real code, use the current date/time
-        self.sale_tx_crud.add_transaction(date, cashier_id, transaction_data, self.sale_items)
+        self.sale_tx_crud.checkout(date, cashier_id, transaction_data, self.sale_items, location_id)
         return transaction_data
     
 
@@ -1,22 +1,15 @@
 import sale_item as si
-import psycopg2
 from psycopg2.extras import RealDictCursor  # Returns rows as dictionaries
+from db import DatabaseClient
+from inventory_crud_pg import take_stock
+from prepared_statements import execute_statement
 
-class sale_transaction_crud:
+class sale_transaction_crud(DatabaseClient):
     """Database CRUD operations for sale_transaction table"""
 
-    def __init__(self, host, database, user, password):
-        # Store database connection parameters
-        self.config = {
-            "host": host,
-            "database": database,
-            "user": user,
-            "password": password
-        }
-
-    def connect(self):
-        """Create and return a new database connection"""
-        return psycopg2.connect(**self.config)
+    def __init__(self, host, database, user, password, pool=None):
+        # Optional psycopg2 pool; pooled connections keep their prepared statements
+        super().__init__(host, database, user, password, pool)
     
             #sale_transaction fields:
             # transaction_id integer,
@@ -27,67 +20,70 @@ class sale_transaction_crud:
             # discount numeric(10, 2),
             # total numeric(10, 2)
 
-    def add_transaction(self, date, cashier_id, transaction_data, sale_items):
-        """Add a sale transaction to the database"""
+    def add_transaction(self, date, cashier_id, transaction_data, sale_items, location_id=None):
+        """Add a sale transaction and its items to the database in one transaction"""
+        return self._save(date, cashier_id, transaction_data, sale_items, location_id, False)
+
+    def checkout(self, date, cashier_id, transaction_data, sale_items, location_id=None):
+        """Take the sold items off stock and record the sale in one transaction.
+        Raises ValueError (and records nothing) if any item is short."""
+        return self._save(date, cashier_id, transaction_data, sale_items, location_id, True)
+
+    def _save(self, date, cashier_id, transaction_data, sale_items, location_id, take):
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
+        prepare = self.pool is not None
 
         try:
-            sql = """
-                INSERT INTO sale_transaction
-                (date, cashier_id, subtotal, tax, discount, total)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING transaction_id;
-            """
+            if take:
+                take_stock(conn, ((item.product["id"], item.quantity) for item in sale_items),
+                           location_id, prepare=prepare)
 
-            cursor.execute(sql, (
+            execute_statement(cursor, "sale_transaction_insert", (
                 date, cashier_id,
                 transaction_data["subtotal"],
                 transaction_data["tax"],
                 transaction_data["discount"],
-                transaction_data["total"]
-            ))
+                transaction_data["total"],
+                location_id
+            ), prepare=prepare)
 
             new_id = cursor.fetchone()["transaction_id"]
-            conn.commit()  # Save changes to database
 
             # Add each sale item to the sale_item table
             for item in sale_items:
-                self.add_sale_item(item, new_id)
+                self._insert_sale_item(cursor, item, new_id, prepare)
 
+            conn.commit()  # Save changes to database
             return new_id
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
 
     def add_sale_item(self, sale_item, transaction_id: int):
-        """Add an item to the current sale transaction"""
+        """Add an item to an existing sale transaction"""
         conn = self.connect()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         try:
-            # sale_item fields:
-                # sale_item_id integer,
-                # transaction_id integer,
-                # product_id integer,
-                # "quantity " integer,
-                # price_at_sale numeric(10, 2)
-            sql = """
-                INSERT INTO sale_item
-                (transaction_id, product_id, quantity, price_at_sale)
-                VALUES (%s, %s, %s, %s)
-                RETURNING sale_item_id;
-            """
-
-            cursor.execute(sql, (
-                transaction_id, sale_item.product["id"], sale_item.quantity, sale_item.price
-            ))
-
-            new_id = cursor.fetchone()["sale_item_id"]
+            new_id = self._insert_sale_item(cursor, sale_item, transaction_id, self.pool is not None)
             conn.commit()  # Save changes to database
             return new_id
         finally:
             cursor.close()
-            conn.close()
+            self.release(conn)
 
-        
\ No newline at end of file
+    def _insert_sale_item(self, cursor, sale_item, transaction_id, prepare):
+        # sale_item fields:
+            # sale_item_id integer,
+            # transaction_id integer,
+            # product_id integer,
+            # "quantity " integer,
+            # price_at_sale numeric(10, 2)
+        execute_statement(cursor, "sale_item_insert", (
+            transaction_id, sale_item.product["id"], sale_item.quantity, sale_item.price
+        ), prepare=prepare)
+        return cursor.fetchone()["sale_item_id"]
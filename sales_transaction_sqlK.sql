@@ -21,7 +21,8 @@ CREATE TABLE IF NOT EXISTS sale_transaction
     subtotal numeric(10, 2),
     tax numeric(10, 2),
     discount numeric(10, 2),
-    total numeric(10, 2)
+    total numeric(10, 2),
+    location_id integer
 );
 
 CREATE TABLE IF NOT EXISTS saleitem
@@ -64,21 +65,409 @@ ON products (name);
 CREATE INDEX IF NOT EXISTS idx_products_archived
 ON products (archived);
 
--- Test Data
+-- Databases seeded more than once hold duplicate active codes; keep the
+-- oldest product per code active and archive the copies so the index builds
+UPDATE products p
+SET archived = TRUE,
+    updated_at = CURRENT_TIMESTAMP
+FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY product_code ORDER BY id) AS copy_no
+    FROM products
+    WHERE product_code IS NOT NULL AND archived = FALSE
+) d
+WHERE p.id = d.id AND d.copy_no > 1;
+
+-- Till scans look products up by code; codes are unique among active products
+CREATE UNIQUE INDEX IF NOT EXISTS idx_products_product_code
+ON products (product_code)
+WHERE product_code IS NOT NULL AND archived = FALSE;
+
+-- Publish code/price/archive changes so API processes can refresh their
+-- in-memory product code index (see product_code_index.py)
+CREATE OR REPLACE FUNCTION notify_product_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('product_changes', json_build_object(
+            'op', TG_OP, 'id', OLD.id, 'product_code', OLD.product_code)::text);
+        RETURN OLD;
+    END IF;
+
+    IF TG_OP = 'UPDATE'
+       AND NEW.product_code IS NOT DISTINCT FROM OLD.product_code
+       AND NEW.price IS NOT DISTINCT FROM OLD.price
+       AND NEW.archived IS NOT DISTINCT FROM OLD.archived THEN
+        RETURN NEW;
+    END IF;
+
+    PERFORM pg_notify('product_changes', json_build_object(
+        'op', TG_OP, 'id', NEW.id,
+        'product_code', NEW.product_code,
+        'old_code', CASE WHEN TG_OP = 'UPDATE' THEN OLD.product_code END,
+        'price', NEW.price, 'archived', NEW.archived)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_products_notify_change
+AFTER INSERT OR UPDATE OR DELETE ON products
+FOR EACH ROW EXECUTE FUNCTION notify_product_change();
+
+-- Daily demand rollup, maintained incrementally by reorder_forecast.py
+CREATE TABLE IF NOT EXISTS product_daily_demand (
+    product_id INTEGER NOT NULL,
+    sales_day DATE NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, sales_day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_daily_demand_day
+ON product_daily_demand (sales_day);
+
+CREATE INDEX IF NOT EXISTS idx_sale_transaction_date
+ON sale_transaction (date);
+
+-- Output of the reorder forecast job (one row per product)
+CREATE TABLE IF NOT EXISTS reorder_suggestions (
+    product_id INTEGER PRIMARY KEY,
+    avg_daily_demand NUMERIC(12,4) NOT NULL DEFAULT 0,
+    demand_stddev NUMERIC(12,4) NOT NULL DEFAULT 0,
+    suggested_reorder_threshold INTEGER NOT NULL DEFAULT 0,
+    suggested_reorder_quantity INTEGER NOT NULL DEFAULT 0,
+    window_start DATE NOT NULL,
+    window_end DATE NOT NULL,
+    computed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- One row per forecast run; MAX(sales_through) is the incremental watermark
+CREATE TABLE IF NOT EXISTS forecast_runs (
+    id SERIAL PRIMARY KEY,
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sales_through DATE NOT NULL,
+    products_processed INTEGER NOT NULL DEFAULT 0,
+    duration_ms INTEGER
+);
+
+-- First day of the run's window. Every day from MIN(sales_from) to
+-- MAX(sales_through) is rolled up into product_daily_demand.
+ALTER TABLE forecast_runs ADD COLUMN IF NOT EXISTS sales_from DATE;
+
+-- Stock locations (shops and warehouses)
+CREATE TABLE IF NOT EXISTS locations (
+    id SERIAL PRIMARY KEY,
+    code VARCHAR(20) NOT NULL UNIQUE,
+    name VARCHAR(255) NOT NULL,
+    location_type VARCHAR(20) NOT NULL DEFAULT 'store',
+    archived BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Per-location stock. The primary key leads with location_id so every
+-- store-scoped lookup is an index range scan over that store only.
+CREATE TABLE IF NOT EXISTS product_stock (
+    location_id INTEGER NOT NULL REFERENCES locations (id),
+    product_id INTEGER NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (location_id, product_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_stock_product
+ON product_stock (product_id);
+
+ALTER TABLE sale_transaction ADD COLUMN IF NOT EXISTS location_id INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_sale_transaction_location_date
+ON sale_transaction (location_id, date);
+
+-- products.current_quantity is the total over all locations. Stock is only
+-- ever changed in product_stock (the MAIN location when no location is
+-- given); changes are appended here (insert-only, so stores never wait on
+-- each other's locks) and folded into the total by fold_product_stock_totals(),
+-- the only writer of current_quantity. The fold_stock_totals job runs it every
+-- minute, so a job worker (python jobs.py worker) must run alongside the app;
+-- without one this table only grows.
+CREATE TABLE IF NOT EXISTS product_stock_deltas (
+    id BIGSERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    delta INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_stock_deltas_product
+ON product_stock_deltas (product_id);
+
+CREATE OR REPLACE FUNCTION record_product_stock_delta() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO product_stock_deltas (product_id, delta) VALUES (NEW.product_id, NEW.quantity);
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.quantity <> OLD.quantity THEN
+            INSERT INTO product_stock_deltas (product_id, delta) VALUES (NEW.product_id, NEW.quantity - OLD.quantity);
+        END IF;
+    ELSE
+        INSERT INTO product_stock_deltas (product_id, delta) VALUES (OLD.product_id, -OLD.quantity);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_product_stock_delta
+AFTER INSERT OR UPDATE OF quantity OR DELETE ON product_stock
+FOR EACH ROW EXECUTE FUNCTION record_product_stock_delta();
+
+-- Folds every pending change, or only those of the given products (used by
+-- admin edits that must show the new total straight away)
+DROP FUNCTION IF EXISTS fold_product_stock_totals();
+
+CREATE OR REPLACE FUNCTION fold_product_stock_totals(only_products INTEGER[] DEFAULT NULL)
+RETURNS INTEGER AS $$
+DECLARE
+    locked INTEGER[];
+    changed INTEGER;
+BEGIN
+    -- Lock the products in id order before taking their deltas, so a full fold
+    -- and an admin edit (which holds its product rows, then folds them) cannot
+    -- deadlock on each other
+    SELECT array_agg(id) INTO locked FROM (
+        SELECT p.id FROM products p
+        WHERE p.id IN (
+            SELECT d.product_id FROM product_stock_deltas d
+            WHERE only_products IS NULL OR d.product_id = ANY(only_products)
+        )
+        ORDER BY p.id
+        FOR UPDATE OF p
+    ) l;
+
+    WITH folded AS (
+        DELETE FROM product_stock_deltas d
+        WHERE d.product_id = ANY(locked)
+        -- Stock of hard-deleted products has nothing left to fold into
+        OR ((only_products IS NULL OR d.product_id = ANY(only_products))
+            AND NOT EXISTS (SELECT 1 FROM products p WHERE p.id = d.product_id))
+        RETURNING d.product_id, d.delta
+    ), totals AS (
+        SELECT product_id, SUM(delta) AS delta FROM folded GROUP BY product_id
+    )
+    UPDATE products p
+    SET current_quantity = p.current_quantity + t.delta,
+        updated_at = CURRENT_TIMESTAMP
+    FROM totals t
+    WHERE p.id = t.product_id AND t.delta <> 0;
+
+    GET DIAGNOSTICS changed = ROW_COUNT;
+    RETURN changed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Live total stock of a product: its folded current_quantity plus the changes
+-- not folded yet. Reads use this, so a sale shows up before the next fold.
+CREATE OR REPLACE FUNCTION product_quantity(product INTEGER, folded INTEGER)
+RETURNS INTEGER AS $$
+    SELECT folded + COALESCE(SUM(d.delta), 0)::INTEGER
+    FROM product_stock_deltas d
+    WHERE d.product_id = product
+$$ LANGUAGE sql STABLE;
+
+-- Last purchase cost per unit; stock valuation falls back to price when unset
+ALTER TABLE products ADD COLUMN IF NOT EXISTS unit_cost NUMERIC(10,2);
+
+-- Every change to product_stock as it happens, with the unit cost at the time
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id BIGSERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    moved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    quantity INTEGER NOT NULL,
+    unit_cost NUMERIC(12,4) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_moved_at
+ON stock_movements (moved_at);
+
+-- Movements used to be taken from products.current_quantity, which only
+-- changes when location stock is folded (late, netted and at the fold-time cost)
+DROP TRIGGER IF EXISTS trg_products_stock_movement ON products;
+
+-- Receipts store their cost on products.unit_cost before changing the stock,
+-- so the movement carries it. Removed rows (including a hard-deleted
+-- product's stock) leave with -quantity; the product may already be gone.
+CREATE OR REPLACE FUNCTION record_stock_movement() RETURNS trigger AS $$
+DECLARE
+    delta INTEGER;
+    moved_product INTEGER;
+    cost NUMERIC(12,4);
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        delta := NEW.quantity;
+        moved_product := NEW.product_id;
+    ELSIF TG_OP = 'UPDATE' THEN
+        delta := NEW.quantity - OLD.quantity;
+        moved_product := NEW.product_id;
+    ELSE
+        delta := -OLD.quantity;
+        moved_product := OLD.product_id;
+    END IF;
+
+    IF delta <> 0 THEN
+        SELECT COALESCE(unit_cost, price) INTO cost FROM products WHERE id = moved_product;
+        INSERT INTO stock_movements (product_id, quantity, unit_cost)
+        VALUES (moved_product, delta, COALESCE(cost, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_product_stock_movement
+AFTER INSERT OR UPDATE OF quantity OR DELETE ON product_stock
+FOR EACH ROW EXECUTE FUNCTION record_stock_movement();
+
+-- Month-end valuation snapshots written by inventory_valuation.py
+CREATE TABLE IF NOT EXISTS inventory_snapshots (
+    period_end DATE NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    avg_unit_cost NUMERIC(12,4) NOT NULL DEFAULT 0,
+    fifo_layers JSONB NOT NULL DEFAULT '[]',
+    avg_value NUMERIC(14,2) NOT NULL DEFAULT 0,
+    fifo_value NUMERIC(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (period_end, product_id)
+);
+
+-- One row per snapshot with the totals, so past months are a single-row read
+CREATE TABLE IF NOT EXISTS inventory_valuation_periods (
+    period_end DATE PRIMARY KEY,
+    total_quantity BIGINT NOT NULL DEFAULT 0,
+    avg_value NUMERIC(16,2) NOT NULL DEFAULT 0,
+    fifo_value NUMERIC(16,2) NOT NULL DEFAULT 0,
+    product_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Background jobs (jobs.py): queue, per-attempt timings and recurring schedules
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    task VARCHAR(100) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    priority SMALLINT NOT NULL DEFAULT 0,
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    -- NULL: the task's own default, filled in by the worker that claims the job
+    max_attempts INTEGER,
+    timeout_seconds INTEGER,
+    schedule_name VARCHAR(100),
+    worker VARCHAR(100),
+    result JSONB,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    CONSTRAINT chk_jobs_status CHECK (status IN ('queued', 'running', 'succeeded', 'failed'))
+);
+
+-- Workers touch their running jobs every maintenance tick; requeue_stale()
+-- only takes back jobs whose worker stopped doing that
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+
+-- Workers only ever scan the queued jobs
+CREATE INDEX IF NOT EXISTS idx_jobs_queued
+ON jobs (priority DESC, run_at)
+WHERE status = 'queued';
+
+CREATE INDEX IF NOT EXISTS idx_jobs_running
+ON jobs (task)
+WHERE status = 'running';
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    id BIGSERIAL PRIMARY KEY,
+    job_id BIGINT NOT NULL,
+    task VARCHAR(100) NOT NULL,
+    attempt INTEGER NOT NULL,
+    worker VARCHAR(100),
+    status VARCHAR(20) NOT NULL,
+    wait_ms INTEGER NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    finished_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_runs_finished_at
+ON job_runs (finished_at);
+
+CREATE TABLE IF NOT EXISTS job_schedules (
+    name VARCHAR(100) PRIMARY KEY,
+    task VARCHAR(100) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    interval_seconds INTEGER NOT NULL CHECK (interval_seconds > 0),
+    next_run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    enabled BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+INSERT INTO job_schedules (name, task, interval_seconds) VALUES
+('fold_stock_totals', 'fold_stock_totals', 60),
+('reorder_forecast', 'reorder_forecast', 86400),
+('month_end_snapshot', 'month_end_snapshot', 86400),
+('prune_jobs', 'prune_jobs', 86400)
+ON CONFLICT (name) DO NOTHING;
+
+-- Product change history written by product_audit.py; only changed fields,
+-- as {"field": [before, after]}. No FK so history outlives a hard delete.
+CREATE TABLE IF NOT EXISTS product_audit (
+    id BIGSERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    action VARCHAR(10) NOT NULL,
+    changed_by INTEGER,
+    changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    changes JSONB NOT NULL,
+    CONSTRAINT chk_product_audit_action CHECK (action IN ('create', 'update', 'archive', 'delete'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_audit_product_time
+ON product_audit (product_id, changed_at);
+
+-- Test Data (skipped when the code is already in use)
 INSERT INTO products (product_code, name, category_id, price, current_quantity, reorder_threshold, archived, created_by, last_updated_by)
-VALUES ('MILK001', 'Whole Milk 1L', 1, 2.49, 120, 20, FALSE, 1, 1);
+VALUES ('MILK001', 'Whole Milk 1L', 1, 2.49, 120, 20, FALSE, 1, 1)
+ON CONFLICT DO NOTHING;
 
 INSERT INTO products (product_code, name, category_id, price, current_quantity, reorder_threshold, archived, created_by, last_updated_by)
-VALUES ('BRED002', 'Whole Wheat Bread', 2, 1.99, 80, 15, FALSE, 1, 1);
+VALUES ('BRED002', 'Whole Wheat Bread', 2, 1.99, 80, 15, FALSE, 1, 1)
+ON CONFLICT DO NOTHING;
 
 INSERT INTO products (product_code, name, category_id, price, current_quantity, reorder_threshold, archived, created_by, last_updated_by)
-VALUES ('APPL003', 'Red Apples (1kg)', 3, 3.50, 60, 10, FALSE, 1, 1);
+VALUES ('APPL003', 'Red Apples (1kg)', 3, 3.50, 60, 10, FALSE, 1, 1)
+ON CONFLICT DO NOTHING;
 
 INSERT INTO products (product_code, name, category_id, price, current_quantity, reorder_threshold, archived, created_by, last_updated_by)
-VALUES ('EGGS004', 'Large Eggs (12 pack)', 4, 4.25, 40, 8, FALSE, 1, 1);
+VALUES ('EGGS004', 'Large Eggs (12 pack)', 4, 4.25, 40, 8, FALSE, 1, 1)
+ON CONFLICT DO NOTHING;
 
 INSERT INTO products (product_code, name, category_id, price, current_quantity, reorder_threshold, archived, created_by, last_updated_by)
-VALUES ('RICE005', 'Basmati Rice 5kg', 5, 12.99, 25, 5, FALSE, 1, 1);
+VALUES ('RICE005', 'Basmati Rice 5kg', 5, 12.99, 25, 5, FALSE, 1, 1)
+ON CONFLICT DO NOTHING;
+
+-- Existing stock starts out in a single main location; seeding must not
+-- count it a second time in the totals (its movements are the opening balance)
+INSERT INTO locations (code, name, location_type)
+VALUES ('MAIN', 'Main store', 'store')
+ON CONFLICT (code) DO NOTHING;
+
+ALTER TABLE product_stock DISABLE TRIGGER trg_product_stock_delta;
+INSERT INTO product_stock (location_id, product_id, quantity)
+SELECT l.id, p.id, p.current_quantity
+FROM products p, locations l
+WHERE l.code = 'MAIN'
+ON CONFLICT (location_id, product_id) DO NOTHING;
+ALTER TABLE product_stock ENABLE TRIGGER trg_product_stock_delta;
+
+-- Sales recorded without a location took their stock from MAIN
+UPDATE sale_transaction
+SET location_id = (SELECT id FROM locations WHERE code = 'MAIN')
+WHERE location_id IS NULL;
 
+-- Opening balance for products that existed before movements were recorded
+INSERT INTO stock_movements (product_id, quantity, unit_cost)
+SELECT p.id, p.current_quantity, COALESCE(p.unit_cost, p.price)
+FROM products p
+WHERE p.current_quantity <> 0
+AND NOT EXISTS (SELECT 1 FROM stock_movements m WHERE m.product_id = p.id);
 
 END;
\ No newline at end of file